@@ -1,8 +1,27 @@
 import bpy
 import os
+import sys
 import math
 import mathutils
 import time
+import struct
+import zlib
+import hashlib
+import json
+import shutil
+import subprocess
+import threading
+import contextlib
+import collections
+import itertools
+import functools
+import concurrent.futures
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 bl_info = {
     "name": "Unity VFX Graph Six way lighting",
@@ -13,6 +32,12 @@ bl_info = {
 _restore_info = {}
 
 _light_direction_names = ("Right", "Left", "Bottom", "Top", "Front", "Back")
+#compact lightmaps store the luminance of each light direction in the channel it takes in the
+#positive and negative images, with the alpha once
+_compact_lightmap_layers = {
+    "LightsPositive": ("Right", "Top", "Back", "Alpha"),
+    "LightsNegative": ("Left", "Bottom", "Front", None),
+}
 _node_separation = (200, 100)
 
 _rgba_combiner_node_group_name = "UnityRGBACombinerGroup"
@@ -20,7 +45,46 @@ _6way_combiner_node_group_name = "Unity6wayCombinerGroup"
 
 _compositor_debug = False
 
-def _get_frames_range(scene):
+_cache_filename = "unity6way_cache"
+_trim_filename = "unity6way_trim"
+_report_filename = "unity6way_report"
+_node_ui_properties = {'location', 'width', 'width_hidden', 'height', 'dimensions', 'select', 'hide', 'label',
+    'use_custom_color', 'color', 'show_options', 'show_preview', 'show_texture'}
+
+_rendered_frames = []
+_frames_override = None
+_is_worker = False
+_active_render = None
+_active_pipeline = None
+_active_overlap = None
+_overlapped_atlas = None
+_frame_store = None
+_run_report = None
+_frame_render_start = 0
+_output_states = collections.OrderedDict()
+_output_states_limit = 1024
+_output_drawn_paths = set()
+_output_scanner = None
+_output_scans = []
+_output_rescan_interval = 2.0
+_trim_resolution = 64
+_trim_samples = 4
+_trim_threshold = 1 / 255
+_emission_index = {}
+#nodes whose output follows the scene time without any hashed setting changing
+_time_dependent_node_types = {'GeometryNodeInputSceneTime', 'GeometryNodeSimulationInput', 'GeometryNodeSimulationOutput', 'GeometryNodeBake'}
+#object types without geometry of their own in the render
+_geometryless_object_types = {'EMPTY', 'ARMATURE', 'LATTICE', 'SPEAKER', 'LIGHT_PROBE', 'LIGHT', 'CAMERA'}
+_quantize_luts = {}
+
+_luminance_coefficients = np.array((0.2126, 0.7152, 0.0722), dtype=np.float32)
+
+_exr_magic = b'\x76\x2f\x31\x01'
+_exr_compressions = ('NONE', 'RLE', 'ZIPS', 'ZIP', 'PIZ', 'PXR24', 'B44', 'B44A', 'DWAA', 'DWAB')
+_exr_lines_per_block = {'NONE': 1, 'RLE': 1, 'ZIPS': 1, 'ZIP': 16, 'PIZ': 32, 'PXR24': 16, 'B44': 32, 'B44A': 32, 'DWAA': 32, 'DWAB': 256}
+_exr_pixel_types = (np.dtype('<u4'), np.dtype('<f2'), np.dtype('<f4'))
+
+def _get_full_frames_range(scene):
     unity6way = scene.unity6way
     match unity6way.frames:
         case 'CURRENT':
@@ -34,6 +98,97 @@ def _get_frames_range(scene):
             frame_end = unity6way.frame_end
     return frame_start, frame_end
 
+def _is_trimmed(scene):
+    #visible frames found by the last trim pre-pass over the same range
+    unity6way = scene.unity6way
+    return unity6way.trim_empty_frames and tuple(unity6way.trimmed_range[:2]) == _get_full_frames_range(scene)
+
+def _get_frames_range(scene):
+    if _is_trimmed(scene):
+        return tuple(scene.unity6way.trimmed_range[2:])
+    return _get_full_frames_range(scene)
+
+def _get_flipbook_frame_step(scene):
+    flipbook = scene.unity6way.flipbook
+    if scene.unity6way.trim_flipbook and _is_trimmed(scene):
+        #the tiles are spread over the visible frames, the frame step setting is kept
+        frame_start, frame_end = _get_frames_range(scene)
+        return max(1, -(-(frame_end - frame_start + 1) // (flipbook.tiling[0] * flipbook.tiling[1])))
+    return flipbook.frame_step
+
+def _get_flipbook_frames(scene):
+    # source frame of each flipbook tile, in tile order
+    flipbook = scene.unity6way.flipbook
+    frame_step = _get_flipbook_frame_step(scene)
+    if _frames_override != None and not _is_worker:
+        #frames picked on the command line, the frame step walks their list
+        frames = sorted(_frames_override)
+        tile_count = min(len(frames), flipbook.tiling[0] * flipbook.tiling[1])
+        return [frames[min(len(frames) - 1, i * frame_step)] for i in range(tile_count)]
+    frame_start, frame_end = _get_frames_range(scene)
+    tile_count = min(frame_end - frame_start + 1, flipbook.tiling[0] * flipbook.tiling[1])
+    return [min(frame_end, frame_start + i * frame_step) for i in range(tile_count)]
+
+def _get_render_frames(scene):
+    if _frames_override != None:
+        return list(_frames_override)
+    unity6way = scene.unity6way
+    if unity6way.flipbook.enabled and unity6way.flipbook_frames_only:
+        return sorted(set(_get_flipbook_frames(scene)))
+    frame_start, frame_end = _get_frames_range(scene)
+    return list(range(frame_start, frame_end + 1))
+
+def _get_flipbook_tiles(frames, tiling):
+    # (tile x, tile y, frame) of each tile, tile rows counted from the bottom like bpy image pixels
+    tiles = []
+    for tile_index, frame in enumerate(frames):
+        tile_x = tile_index % tiling[0]
+        tile_y = tiling[1] - tile_index // tiling[0] - 1
+        tiles.append((tile_x, tile_y, frame))
+    return tiles
+
+def _get_render_resolution(scene, stage):
+    # lightmap and emissive renders are reduced to the pixels the flipbook tiles keep,
+    # node compositing renders at the same size so its render size scaling matches the lightmaps
+    render = scene.render
+    width = max(1, render.resolution_x * render.resolution_percentage // 100)
+    height = max(1, render.resolution_y * render.resolution_percentage // 100)
+    unity6way = scene.unity6way
+    if stage in ('LIGHTMAPS', 'EMISSIVE', 'COMPOSITING') and unity6way.auto_resolution and unity6way.flipbook.enabled:
+        flipbook = unity6way.flipbook
+        tile_width = flipbook.image_size[0] // flipbook.tiling[0] * unity6way.supersampling
+        tile_height = flipbook.image_size[1] // flipbook.tiling[1] * unity6way.supersampling
+        #the scene aspect ratio is kept, the render covers the supersampled tile on both axes
+        scale = min(1.0, max(tile_width / width, tile_height / height))
+        width = max(1, math.ceil(width * scale))
+        height = max(1, math.ceil(height * scale))
+    return width, height
+
+def _use_lightgroups(scene):
+    return scene.unity6way.lightmaps.use_lightgroups and scene.render.engine == 'CYCLES'
+
+def _use_lightmaps_emissive(scene):
+    return scene.unity6way.lightmaps.include_emissive and _use_lightgroups(scene)
+
+def _use_direct_compositing(scene):
+    # the built-in OpenEXR reader decodes ZIP lightmaps only, Blender composites the others
+    unity6way = scene.unity6way
+    return unity6way.compositing.direct and unity6way.lightmaps.exr_codec == 'ZIP'
+
+def _use_memory_handoff(scene):
+    unity6way = scene.unity6way
+    flipbook = unity6way.flipbook
+    return (unity6way.memory_handoff and unity6way.compositing.enabled and _use_direct_compositing(scene)
+        and flipbook.enabled and flipbook.filter != 'BLENDER' and not flipbook.share_duplicates)
+
+def _use_overlap(scene):
+    unity6way = scene.unity6way
+    compositing = unity6way.compositing
+    if compositing.extra == 'CUSTOM' and not _file_exists(bpy.path.abspath(compositing.custom_path)):
+        return False
+    return (unity6way.overlap_stages and unity6way.workers == 1 and unity6way.lightmaps.enabled
+        and compositing.enabled and _use_direct_compositing(scene))
+
 def _get_current_frame(scene):
     frame_start, frame_end = _get_frames_range(scene)
     return max(frame_start, min(frame_end, scene.frame_current))
@@ -57,6 +212,7 @@ def _create_compositor_node_exr_output(tree):
     output_node.format.file_format = 'OPEN_EXR'
     output_node.format.color_mode = 'RGBA'
     output_node.format.color_depth = '16'
+    output_node.format.exr_codec = 'ZIP'
     output_node.format.quality = 100
     return output_node
     
@@ -65,6 +221,7 @@ def _create_compositor_node_exr_multilayer_output(tree):
     output_node.format.file_format = 'OPEN_EXR_MULTILAYER'
     output_node.format.color_mode = 'RGBA'
     output_node.format.color_depth = '16'
+    output_node.format.exr_codec = 'ZIP'
     output_node.format.quality = 100
     return output_node
 
@@ -113,12 +270,64 @@ def _get_export_paths(unity6way):
     path2 = _get_input_path(output_path, filenames[1], extension)
     return (path1, path2)
 
+def _get_tile_index_path(unity6way):
+    return os.path.splitext(_get_export_paths(unity6way)[0])[0] + "_tiles.json"
+
 def _file_exists(path):
     return os.path.exists(path)
 
-def _check_input_path(missing_paths, path):
-    if not _file_exists(path):
-        missing_paths.append(path)
+def _scan_output_states(paths):
+    #runs on the scanner thread, the main thread applies the results
+    return {path: os.path.exists(path) for path in paths}
+
+def _rescan_output_states(paths = None):
+    # stats run on a background thread so panel draws never wait on the filesystem,
+    # without paths only the paths drawn since the last rescan are checked again
+    global _output_scanner
+    if bpy.app.background:
+        return
+    if _output_scanner == None:
+        _output_scanner = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    if paths == None:
+        if any(not scan.done() for scan in _output_scans):
+            return
+        paths = list(_output_drawn_paths)
+        _output_drawn_paths.clear()
+    if paths:
+        _output_scans.append(_output_scanner.submit(_scan_output_states, list(paths)))
+
+def _apply_output_scans():
+    # returns whether a drawn state changed, the least recently used paths are forgotten
+    changed = False
+    for scan in [scan for scan in _output_scans if scan.done()]:
+        _output_scans.remove(scan)
+        for path, exists in scan.result().items():
+            if path in _output_states and _output_states[path] != exists:
+                changed = True
+                _output_states[path] = exists
+    while len(_output_states) > _output_states_limit:
+        _output_states.popitem(last=False)
+    return changed
+
+def _output_exists(path):
+    _output_drawn_paths.add(path)
+    exists = _output_states.get(path)
+    if exists == None:
+        #unknown until the scanner has checked it
+        _output_states[path] = False
+        _rescan_output_states((path,))
+    else:
+        _output_states.move_to_end(path)
+    return exists == True
+
+def _on_output_states_timer():
+    if _apply_output_scans():
+        for window in bpy.context.window_manager.windows:
+            for area in window.screen.areas:
+                if area.type == 'VIEW_3D':
+                    area.tag_redraw()
+    _rescan_output_states()
+    return _output_rescan_interval
 
 def _load_image(path):
     filename = bpy.path.basename(path)
@@ -127,7 +336,812 @@ def _load_image(path):
         bpy.data.images.remove(image)
     return bpy.data.images.load(path, check_existing=False)
 
+def _get_image_pixels(image):
+    width, height = image.size
+    channels = image.channels
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, channels)
+    if channels != 4:
+        rgba = np.ones((height, width, 4), dtype=np.float32)
+        #greyscale images fill the colour channels, alpha stays opaque
+        if channels == 1:
+            rgba[:, :, :3] = pixels
+        else:
+            rgba[:, :, :channels] = pixels
+        pixels = rgba
+    return pixels
+
+def _get_tile_view(pixels, tile_x, tile_y, tile_width, tile_height):
+    x = tile_x * tile_width
+    y = tile_y * tile_height
+    return pixels[..., y:y+tile_height, x:x+tile_width, :]
+
+def _get_quantize_lut(bits, srgb):
+    # encoded value of each step of the clipped linear input, in output units
+    key = (bits, srgb)
+    lut = _quantize_luts.get(key)
+    if lut is None:
+        values = np.linspace(0, 1, 1 << (16 if bits == 8 else 20))
+        if srgb:
+            values = np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+        lut = (values * ((1 << bits) - 1)).astype(np.float32)
+        _quantize_luts[key] = lut
+    return lut
+
+def _quantize(pixels, settings, seed = 0):
+    # RGBA floats to 8 or 16-bit integers, alpha is never sRGB encoded
+    bits = settings["bits"]
+    values = np.empty(pixels.shape, dtype=np.float32)
+    for channels, srgb in ((slice(0, 3), settings["srgb"]), (slice(3, 4), False)):
+        lut = _get_quantize_lut(bits, srgb)
+        indices = (np.clip(pixels[..., channels], 0, 1) * (len(lut) - 1) + 0.5).astype(np.uint32)
+        values[..., channels] = lut[indices]
+    if settings["dither"]:
+        #triangular noise of one step hides banding in smooth gradients
+        rng = np.random.default_rng(seed)
+        values += rng.random(values.shape, dtype=np.float32) - rng.random(values.shape, dtype=np.float32)
+    values += 0.5
+    np.clip(values, 0, (1 << bits) - 1, out=values)
+    return values.astype(np.uint8 if bits == 8 else np.uint16)
+
+def _encode_tga_rle(pixels):
+    # run-length packets of at most 128 pixels that never cross a row, pixels are (rows, width) uint32
+    rows, width = pixels.shape
+    flat = pixels.ravel()
+    count = flat.size
+
+    run_start_mask = np.ones(count, dtype=bool)
+    run_start_mask[1:] = flat[1:] != flat[:-1]
+    run_start_mask[::width] = True
+    run_starts = np.flatnonzero(run_start_mask)
+    run_lengths = np.diff(np.append(run_starts, count))
+
+    #runs longer than a packet are split into segments
+    chunks = (run_lengths + 127) // 128
+    segment_runs = np.repeat(np.arange(len(run_starts)), chunks)
+    segment_chunks = np.arange(len(segment_runs)) - np.repeat(np.cumsum(chunks) - chunks, chunks)
+    segment_starts = run_starts[segment_runs] + segment_chunks * 128
+    segment_lengths = np.minimum(run_lengths[segment_runs] - segment_chunks * 128, 128)
+    segment_count = len(segment_starts)
+
+    #single pixels are gathered in raw packets, starting again at each row and every 128 pixels
+    literal = segment_lengths == 1
+    sequence_start = literal & ((segment_starts % width == 0) | np.concatenate(([True], ~literal[:-1])))
+    sequence_first = np.maximum.accumulate(np.where(sequence_start, np.arange(segment_count), 0))
+    packet_start = ~literal | ((np.arange(segment_count) - sequence_first) % 128 == 0)
+    packet_ids = np.cumsum(packet_start) - 1
+    packet_first = np.flatnonzero(packet_start)
+    packet_rle = ~literal[packet_first]
+    packet_pixels = np.where(packet_rle, segment_lengths[packet_first], np.bincount(packet_ids))
+
+    packet_sizes = 1 + np.where(packet_rle, 4, packet_pixels * 4)
+    packet_offsets = np.cumsum(packet_sizes) - packet_sizes
+    data = np.empty(int(packet_sizes.sum()), dtype=np.uint8)
+    data[packet_offsets] = np.where(packet_rle, 0x80 | (packet_pixels - 1), packet_pixels - 1)
+
+    pixel_bytes = flat.view(np.uint8).reshape(-1, 4)
+    byte_offsets = np.arange(4)
+    rle_packets = np.flatnonzero(packet_rle)
+    data[(packet_offsets[rle_packets] + 1)[:, None] + byte_offsets] = pixel_bytes[segment_starts[packet_first[rle_packets]]]
+    literal_segments = np.flatnonzero(literal & ~packet_rle[packet_ids])
+    literal_packets = packet_ids[literal_segments]
+    literal_offsets = packet_offsets[literal_packets] + 1 + (literal_segments - packet_first[literal_packets]) * 4
+    data[literal_offsets[:, None] + byte_offsets] = pixel_bytes[segment_starts[literal_segments]]
+    return data.tobytes()
+
+class _PngStreamWriter:
+    # 8 or 16-bit RGBA PNG written row band by row band, rows given top-down
+
+    def __init__(self, path, width, height, bits = 8, level = 6):
+        self._file = open(path, 'wb')
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bits, 6, 0, 0, 0))
+        self._compressor = zlib.compressobj(level)
+        self._previous_row = np.zeros(width * 4 * bits // 8, dtype=np.uint8)
+
+    def _write_chunk(self, tag, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(tag)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag))))
+
+    def write_rows(self, rows):
+        if rows.dtype == np.uint16:
+            rows = rows.astype('>u2').view(np.uint8)
+        rows = rows.reshape(rows.shape[0], -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2 # 'Up' filter
+        filtered[0, 1:] = rows[0] - self._previous_row
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self._previous_row = rows[-1].copy()
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+    def close(self):
+        self._write_chunk(b'IDAT', self._compressor.flush())
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
+
+class _TgaStreamWriter:
+    # 8-bit BGRA targa with top-left origin, raw or run-length encoded, rows given top-down
+
+    def __init__(self, path, width, height, rle = False):
+        self._file = open(path, 'wb')
+        self._rle = rle
+        self._file.write(struct.pack('<BBBHHBHHHHBB', 0, 0, 10 if rle else 2, 0, 0, 0, 0, 0, width, height, 32, 0x28))
+
+    def write_rows(self, rows):
+        pixels = np.ascontiguousarray(rows[..., [2, 1, 0, 3]])
+        if self._rle:
+            self._file.write(_encode_tga_rle(pixels.view(np.uint32).reshape(pixels.shape[:2])))
+        else:
+            self._file.write(pixels.tobytes())
+
+    def close(self):
+        self._file.close()
+
+class _DdsStreamWriter:
+    # uncompressed 8-bit BGRA DirectDraw surface, rows given top-down,
+    # rows of the mip levels are kept until the full size level is written
+
+    def __init__(self, path, width, height, mip_count = 1):
+        self._file = open(path, 'wb')
+        self._mips = [[] for _level in range(mip_count - 1)]
+        flags = 0x100f | (0x20000 if mip_count > 1 else 0) # caps, height, width, pitch, pixel format and mip count
+        caps = 0x1000 | (0x400008 if mip_count > 1 else 0) # texture, complex and mipmap
+        pixel_format = struct.pack('<8I', 32, 0x41, 0, 32, 0x00ff0000, 0x0000ff00, 0x000000ff, 0xff000000)
+        self._file.write(b'DDS ' + struct.pack('<7I', 124, flags, height, width, width * 4, 0, mip_count) + bytes(44)
+            + pixel_format + struct.pack('<5I', caps, 0, 0, 0, 0))
+
+    def write_rows(self, rows, level = 0):
+        pixels = np.ascontiguousarray(rows[..., [2, 1, 0, 3]])
+        if level == 0:
+            self._file.write(pixels.tobytes())
+        else:
+            self._mips[level - 1].append(pixels.tobytes())
+
+    def close(self):
+        for level in self._mips:
+            self._file.write(b''.join(level))
+        self._file.close()
+
+def _get_flipbook_write_settings(unity6way):
+    flipbook = unity6way.flipbook
+    return {
+        "format": flipbook.dest_format,
+        "bits": 16 if flipbook.dest_format == 'PNG' and flipbook.color_depth == '16' else 8,
+        "level": flipbook.compression,
+        "rle": flipbook.use_rle,
+        "srgb": flipbook.use_srgb,
+        "dither": flipbook.dither,
+    }
+
+def _open_stream_writer(path, settings, width, height):
+    match settings["format"]:
+        case 'PNG':
+            return _PngStreamWriter(path, width, height, settings["bits"], settings["level"])
+        case 'TARGA':
+            return _TgaStreamWriter(path, width, height, settings["rle"])
+    return None
+
+def _write_image(path, pixels, settings):
+    # float RGBA rows bottom-up like bpy image pixels, quantized and written in bands to bound memory
+    height, width = pixels.shape[:2]
+    if settings["format"] == 'OPEN_EXR':
+        _write_exr_rgba(path, pixels)
+        return
+    writer = _open_stream_writer(path, settings, width, height)
+    rows = pixels[::-1]
+    for band_start in range(0, height, 256):
+        writer.write_rows(_quantize(rows[band_start:band_start + 256], settings, band_start))
+    writer.close()
+
+class _ExrError(Exception):
+    pass
+
+def _parse_exr_header(data):
+    if data[:4] != _exr_magic:
+        raise _ExrError("Not an OpenEXR file")
+    version, = struct.unpack_from('<I', data, 4)
+    if version & 0x1a00:
+        raise _ExrError("Tiled, deep and multi-part OpenEXR files are not supported")
+
+    header = {}
+    offset = 8
+    try:
+        while True:
+            end = data.index(b'\0', offset)
+            name = data[offset:end].decode()
+            offset = end + 1
+            if not name:
+                break
+            end = data.index(b'\0', offset)
+            size, = struct.unpack_from('<i', data, end + 1)
+            value = data[end + 5:end + 5 + size]
+            if len(value) < size:
+                raise _ExrError("Truncated OpenEXR header")
+            offset = end + 5 + size
+            match name:
+                case 'channels':
+                    channels = []
+                    position = 0
+                    while value[position] != 0:
+                        end = value.index(b'\0', position)
+                        pixel_type, _linear, x_sampling, y_sampling = struct.unpack_from('<iB3xii', value, end + 1)
+                        if x_sampling != 1 or y_sampling != 1:
+                            raise _ExrError("Subsampled OpenEXR channels are not supported")
+                        channels.append((value[position:end].decode(), _exr_pixel_types[pixel_type]))
+                        position = end + 17
+                    header['channels'] = channels
+                case 'compression':
+                    header['compression'] = _exr_compressions[value[0]]
+                case 'dataWindow':
+                    header['data_window'] = struct.unpack('<iiii', value)
+    except (ValueError, IndexError, struct.error):
+        raise _ExrError("Truncated OpenEXR header")
+
+    if not all(key in header for key in ('channels', 'compression', 'data_window')):
+        raise _ExrError("Incomplete OpenEXR header")
+    header['offset'] = offset
+    return header
+
+def _read_exr_header(path):
+    with open(path, 'rb') as file:
+        data = file.read(65536)
+    return _parse_exr_header(data)
+
+def _get_exr_size(header):
+    x_min, y_min, x_max, y_max = header['data_window']
+    return x_max - x_min + 1, y_max - y_min + 1
+
+def _exr_unpredict(data):
+    values = np.frombuffer(data, dtype=np.uint8).copy()
+    values[1:] -= 128
+    values = np.cumsum(values, dtype=np.uint8)
+    half = (len(values) + 1) // 2
+    result = np.empty_like(values)
+    result[0::2] = values[:half]
+    result[1::2] = values[half:]
+    return result
+
+def _exr_predict(data):
+    values = np.concatenate((data[0::2], data[1::2]))
+    result = np.empty_like(values)
+    result[0] = values[0]
+    result[1:] = values[1:] - values[:-1] + 128
+    return result
+
+def _decode_exr_rle(data):
+    result = bytearray()
+    position = 0
+    while position < len(data):
+        count = data[position] - 256 if data[position] > 127 else data[position]
+        if count < 0:
+            result += data[position + 1:position + 1 - count]
+            position += 1 - count
+        else:
+            result += data[position + 1:position + 2] * (count + 1)
+            position += 2
+    return bytes(result)
+
+def _decompress_exr_block(data, compression, size):
+    # blocks that do not compress well are stored as is
+    if compression == 'NONE' or len(data) >= size:
+        if len(data) != size:
+            raise _ExrError("Corrupt OpenEXR block")
+        return data
+    match compression:
+        case 'ZIP' | 'ZIPS':
+            try:
+                data = zlib.decompress(data)
+            except zlib.error:
+                raise _ExrError("Corrupt OpenEXR block")
+        case 'RLE':
+            data = _decode_exr_rle(data)
+        case _:
+            raise _ExrError("Unsupported OpenEXR compression: " + compression)
+    if len(data) != size:
+        raise _ExrError("Corrupt OpenEXR block")
+    return _exr_unpredict(data)
+
+def _compress_exr_block(data, compression):
+    if compression in ('ZIP', 'ZIPS'):
+        compressed = zlib.compress(_exr_predict(np.frombuffer(data, dtype=np.uint8)).tobytes(), 4)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+def _read_exr(path):
+    # returns width, height and a dict of float32 channels with rows bottom-up like bpy image pixels
+    with open(path, 'rb') as file:
+        data = file.read()
+    header = _parse_exr_header(data)
+    compression = header['compression']
+    y_min = header['data_window'][1]
+    width, height = _get_exr_size(header)
+    line_size = sum(width * dtype.itemsize for name, dtype in header['channels'])
+    lines = _exr_lines_per_block[compression]
+    block_count = -(-height // lines)
+    if header['offset'] + block_count * 8 > len(data):
+        raise _ExrError("Truncated OpenEXR file")
+
+    pixels = np.empty((height, line_size), dtype=np.uint8)
+    for offset in np.frombuffer(data, dtype='<u8', count=block_count, offset=header['offset']).tolist():
+        if offset + 8 > len(data):
+            raise _ExrError("Truncated OpenEXR file")
+        y, size = struct.unpack_from('<ii', data, offset)
+        block = data[offset + 8:offset + 8 + size]
+        start = y - y_min
+        if len(block) < size or start < 0 or start >= height:
+            raise _ExrError("Truncated OpenEXR file")
+        block_lines = min(lines, height - start)
+        block = _decompress_exr_block(block, compression, block_lines * line_size)
+        pixels[start:start + block_lines] = np.frombuffer(block, dtype=np.uint8).reshape(block_lines, line_size)
+
+    channels = {}
+    position = 0
+    for name, dtype in header['channels']:
+        size = width * dtype.itemsize
+        channel = np.ascontiguousarray(pixels[:, position:position + size]).view(dtype)
+        channels[name] = channel[::-1].astype(np.float32)
+        position += size
+    return width, height, channels
+
+def _write_exr(path, channels, compression='ZIP'):
+    # channels is a dict of (height, width) arrays with rows bottom-up, written as half floats
+    names = sorted(channels)
+    height, width = channels[names[0]].shape
+
+    header = bytearray()
+    def add_attribute(name, type_name, value):
+        header.extend(name.encode() + b'\0' + type_name.encode() + b'\0' + struct.pack('<i', len(value)) + value)
+    channel_list = b''.join(name.encode() + b'\0' + struct.pack('<iB3xii', 1, 0, 1, 1) for name in names) + b'\0'
+    window = struct.pack('<iiii', 0, 0, width - 1, height - 1)
+    add_attribute('channels', 'chlist', channel_list)
+    add_attribute('compression', 'compression', bytes((_exr_compressions.index(compression),)))
+    add_attribute('dataWindow', 'box2i', window)
+    add_attribute('displayWindow', 'box2i', window)
+    add_attribute('lineOrder', 'lineOrder', b'\0')
+    add_attribute('pixelAspectRatio', 'float', struct.pack('<f', 1))
+    add_attribute('screenWindowCenter', 'v2f', struct.pack('<ff', 0, 0))
+    add_attribute('screenWindowWidth', 'float', struct.pack('<f', 1))
+    header.extend(b'\0')
+
+    # scanlines top-down, channels interleaved per line
+    pixels = np.stack([channels[name][::-1] for name in names], axis=1).astype('<f2')
+    lines = _exr_lines_per_block[compression]
+    blocks = []
+    for y in range(0, height, lines):
+        block = _compress_exr_block(pixels[y:y + lines].tobytes(), compression)
+        blocks.append(struct.pack('<ii', y, len(block)) + block)
+
+    offsets = []
+    offset = 8 + len(header) + 8 * len(blocks)
+    for block in blocks:
+        offsets.append(offset)
+        offset += len(block)
+
+    with open(path, 'wb') as file:
+        file.write(_exr_magic + struct.pack('<I', 2))
+        file.write(header)
+        file.write(np.array(offsets, dtype='<u8').tobytes())
+        for block in blocks:
+            file.write(block)
+
+def _get_exr_layer(channels, layer_name):
+    # RGBA pixels of a layer, single channel layers are expanded to gray
+    layer = {}
+    for name, channel in channels.items():
+        parts = name.split('.')
+        if len(parts) >= 2 and parts[-2] == layer_name:
+            layer[parts[-1]] = channel
+    if not layer:
+        raise _ExrError("Missing OpenEXR layer: " + layer_name)
+    if all(key in layer for key in "RGB"):
+        rgb = (layer["R"], layer["G"], layer["B"])
+    else:
+        rgb = (next(iter(layer.values())),) * 3
+    alpha = layer.get("A", np.ones_like(rgb[0]))
+    return np.stack(rgb + (alpha,), axis=-1)
+
+def _get_exr_rgba(channels):
+    rgb = [channels.get(name, channels.get("Y")) for name in "RGB"]
+    if rgb[0] is None:
+        raise _ExrError("Missing OpenEXR color channels")
+    alpha = channels.get("A", np.ones_like(rgb[0]))
+    return np.stack(rgb + [alpha], axis=-1)
+
+def _rgb_to_bw(pixels):
+    return pixels[..., :3] @ _luminance_coefficients
+
+def _premultiplied_to_straight(pixels):
+    alpha = pixels[..., 3:4]
+    np.divide(pixels[..., :3], alpha, out=pixels[..., :3], where=alpha != 0)
+    return pixels
+
+def _combine_rgba(red, green, blue, alpha, multiplier, premultiplied):
+    # same math as the rgba combiner compositor node group
+    pixels = np.stack((red, green, blue, alpha), axis=-1)
+    pixels[..., :3] *= multiplier
+    if not premultiplied:
+        _premultiplied_to_straight(pixels)
+    return np.clip(pixels, 0, 1, out=pixels)
+
+def _get_lightmap_values(channels):
+    # luminance of each light direction and the alpha, from full or compact lightmap files
+    try:
+        layers = {layer_name: _get_exr_layer(channels, layer_name) for layer_name in _compact_lightmap_layers}
+    except _ExrError:
+        return {name: _rgb_to_bw(_get_exr_layer(channels, name)) for name in _light_direction_names + ("Alpha",)}
+    values = {}
+    for layer_name, names in _compact_lightmap_layers.items():
+        for i, name in enumerate(names):
+            if name != None:
+                values[name] = layers[layer_name][..., i]
+    return values
+
+def _composite_6way(values, extra, lightmap_multiplier, extra_multiplier, premultiplied):
+    # same math as the 6-way combiner compositor node group
+    alpha = values["Alpha"]
+    positive = _combine_rgba(values["Right"], values["Top"], values["Back"], alpha, lightmap_multiplier, premultiplied)
+    negative = _combine_rgba(values["Left"], values["Bottom"], values["Front"], alpha, lightmap_multiplier, premultiplied)
+    negative[..., 3] = extra * extra_multiplier
+    return positive, negative
+
+def _mitchell(x):
+    x = np.abs(x)
+    b = c = 1 / 3
+    near = ((12 - 9 * b - 6 * c) * x ** 3 + (-18 + 12 * b + 6 * c) * x ** 2 + (6 - 2 * b)) / 6
+    far = ((-b - 6 * c) * x ** 3 + (6 * b + 30 * c) * x ** 2 + (-12 * b - 48 * c) * x + (8 * b + 24 * c)) / 6
+    return np.where(x < 1, near, np.where(x < 2, far, 0))
+
+def _lanczos3(x):
+    return np.where(np.abs(x) < 3, np.sinc(x) * np.sinc(x / 3), 0)
+
+def _box(x):
+    return np.where((x >= -0.5) & (x < 0.5), 1.0, 0.0)
+
+_resample_filters = {
+    'BOX': (_box, 0.5),
+    'MITCHELL': (_mitchell, 2.0),
+    'LANCZOS': (_lanczos3, 3.0),
+}
+
+def _get_resample_weights(src_size, dst_size, filter):
+    # source indices and normalized weights of each destination pixel, the kernel widens when downscaling
+    kernel, support = _resample_filters[filter]
+    scale = src_size / dst_size
+    kernel_scale = max(scale, 1.0)
+    radius = support * kernel_scale
+    centers = (np.arange(dst_size) + 0.5) * scale
+    indices = np.floor(centers - radius).astype(np.int64)[:, None] + np.arange(int(np.ceil(2 * radius)) + 2)
+    weights = kernel((indices + 0.5 - centers[:, None]) / kernel_scale)
+    weights /= weights.sum(axis=1, keepdims=True)
+    #edge pixels extend outside the image
+    return np.clip(indices, 0, src_size - 1), weights.astype(np.float32)
+
+def _resample_axis(pixels, axis, dst_size, filter):
+    indices, weights = _get_resample_weights(pixels.shape[axis], dst_size, filter)
+    shape = list(pixels.shape)
+    shape[axis] = dst_size
+    result = np.zeros(shape, dtype=np.float32)
+    weight_shape = (dst_size,) + (1,) * (pixels.ndim - axis - 1)
+    for tap in range(indices.shape[1]):
+        tap_weights = weights[:, tap]
+        if tap_weights.any():
+            result += np.take(pixels, indices[:, tap], axis=axis) * tap_weights.reshape(weight_shape)
+    return result
+
+def _resample(pixels, width, height, filter):
+    # (..., height, width, channels) pixels, leading axes hold separate images
+    src_height, src_width = pixels.shape[-3:-1]
+    if (src_width, src_height) == (width, height):
+        return pixels
+    if filter in ('AUTO', 'BOX') and src_width % width == 0 and src_height % height == 0:
+        shape = pixels.shape[:-3] + (height, src_height // height, width, src_width // width, pixels.shape[-1])
+        return pixels.reshape(shape).mean(axis=(-4, -2))
+    if filter == 'AUTO':
+        filter = 'MITCHELL'
+    return _resample_axis(_resample_axis(pixels, pixels.ndim - 2, width, filter), pixels.ndim - 3, height, filter)
+
+def _resample_tile_pair(positive, negative, width, height, filter, premultiplied):
+    # straight channels are weighted by the positive alpha so transparent pixels do not bleed into the tile
+    if not premultiplied:
+        alpha = positive[..., 3:4]
+        positive = np.concatenate((positive[..., :3] * alpha, alpha), axis=-1)
+        #the negative alpha holds the extra, emission where the density is empty is kept
+        negative = np.concatenate((negative[..., :3] * alpha, negative[..., 3:]), axis=-1)
+    pixels = _resample(np.concatenate((positive, negative), axis=-1), width, height, filter)
+    #negative lobes of the sharper filters undershoot
+    np.maximum(pixels, 0, out=pixels)
+    positive = pixels[..., :4]
+    negative = pixels[..., 4:]
+    if not premultiplied:
+        alpha = positive[..., 3:4]
+        scale = np.divide(1, alpha, out=np.zeros_like(alpha), where=alpha > 1e-4)
+        positive[..., :3] *= scale
+        negative[..., :3] *= scale
+    return positive, negative
+
+def _downsample_flipbook(pair, tiling, tile_width, tile_height, filter, premultiplied):
+    # pair holds the tiled area of the positive and negative flipbooks,
+    # every tile is filtered on its own so neighbouring frames do not bleed into each other
+    columns, rows = tiling
+    tiles = [pixels.reshape(rows, pixels.shape[0] // rows, columns, pixels.shape[1] // columns, 4).transpose(0, 2, 1, 3, 4) for pixels in pair]
+    positive, negative = _resample_tile_pair(tiles[0], tiles[1], tile_width, tile_height, filter, premultiplied)
+    return np.stack([pixels.transpose(0, 2, 1, 3, 4).reshape(rows * tile_height, columns * tile_width, 4) for pixels in (positive, negative)])
+
+def _get_flipbook_levels(pixels, tiling, tile_size, level_sizes, filter, premultiplied):
+    # each level is filtered from the previous one, the pixels outside of the tiles stay empty
+    tiled = pixels[:, :tiling[1] * tile_size[1], :tiling[0] * tile_size[0]]
+    for size, level_tile_size in level_sizes:
+        with _report_time("scale_seconds"):
+            tiled = _downsample_flipbook(tiled, tiling, *level_tile_size, filter, premultiplied)
+        level_pixels = np.zeros((2, size[1], size[0], 4), dtype=np.float32)
+        level_pixels[:, :tiled.shape[1], :tiled.shape[2]] = tiled
+        yield level_pixels
+
+def _get_flipbook_level_sizes(image_size, tiling, count = None):
+    # (image size, tile size) of the levels below the full resolution, down to one pixel or until a tile would be empty
+    level_sizes = []
+    for level in range(1, count if count != None else max(image_size).bit_length()):
+        size = (max(1, image_size[0] >> level), max(1, image_size[1] >> level))
+        tile_size = (size[0] // tiling[0], size[1] // tiling[1])
+        if min(tile_size) < 1:
+            break
+        level_sizes.append((size, tile_size))
+    return level_sizes
+
+def _get_tile_padding(flipbook):
+    # gutter around each frame, at least one pixel of the frame is kept
+    tile_size = min(flipbook.image_size[0] // flipbook.tiling[0], flipbook.image_size[1] // flipbook.tiling[1])
+    return max(0, min(flipbook.padding, (tile_size - 1) // 2))
+
+def _pad_tile_pair(pair, padding):
+    #the frame edges are repeated into the gutter, so filtering near a tile border only sees the same frame
+    if padding == 0:
+        return pair
+    return tuple(np.pad(pixels, ((padding, padding), (padding, padding), (0, 0)), mode='edge') for pixels in pair)
+
+def _load_tile_pair(input_paths, width, height, filter, premultiplied, frame = None):
+    # safe to run from worker threads, raises _ExrError for files the built-in reader cannot decode
+    pixels = _frame_store.get('COMPOSITING', frame) if _frame_store != None and frame != None else None
+    if pixels == None:
+        pixels = []
+        with _report_time("load_seconds"):
+            for path in input_paths:
+                _width, _height, channels = _read_exr(path)
+                pixels.append(_get_exr_rgba(channels))
+    with _report_time("scale_seconds"):
+        return _resample_tile_pair(pixels[0], pixels[1], width, height, filter, premultiplied)
+
+def _write_dds(path, levels, settings):
+    # float RGBA rows bottom-up of each mip level, the full size level first
+    height, width = levels[0].shape[:2]
+    writer = _DdsStreamWriter(path, width, height, len(levels))
+    for level, pixels in enumerate(levels):
+        rows = pixels[::-1]
+        for band_start in range(0, len(rows), 256):
+            writer.write_rows(_quantize(rows[band_start:band_start + 256], settings, band_start), level)
+    writer.close()
+
+def _write_exr_rgba(path, pixels):
+    _write_exr(path, {name: pixels[..., i] for i, name in enumerate("RGBA")})
+
+class _FrameStore:
+    # pixels handed from one stage to the next in memory, keyed by (stage, frame),
+    # the oldest frames are written to their files once the memory limit is reached
+
+    def __init__(self, memory_limit, persist, kept_frames):
+        self._frames = collections.OrderedDict()
+        self._kept_frames = set(kept_frames)
+        self._lock = threading.Lock()
+        self._memory_limit = memory_limit
+        self._persist = persist
+        self._size = 0
+        self.spilled_frames = 0
+
+    def _write(self, arrays, paths):
+        for pixels, path in zip(arrays, paths):
+            _write_exr_rgba(path, pixels)
+
+    def put(self, stage, frame, arrays, paths):
+        # returns the arrays as a later stage gets them
+        #half floats, as the files hold them
+        arrays = tuple(np.asarray(pixels, dtype=np.float16) for pixels in arrays)
+        if frame not in self._kept_frames:
+            #frames no later stage reads in memory are written as before
+            self._write(arrays, paths)
+            return tuple(pixels.astype(np.float32) for pixels in arrays)
+        if self._persist:
+            self._write(arrays, paths)
+        else:
+            #a file of an earlier run must not be taken for this frame
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        spilled = []
+        with self._lock:
+            previous = self._frames.pop((stage, frame), None)
+            if previous != None:
+                self._size -= sum(pixels.nbytes for pixels in previous[0])
+            self._frames[(stage, frame)] = (arrays, paths, self._persist)
+            self._size += sum(pixels.nbytes for pixels in arrays)
+            while self._size > self._memory_limit and len(self._frames) > 1:
+                _key, (old_arrays, old_paths, is_written) = self._frames.popitem(last=False)
+                self._size -= sum(pixels.nbytes for pixels in old_arrays)
+                if not is_written:
+                    spilled.append((old_arrays, old_paths))
+                    self.spilled_frames += 1
+        for old_arrays, old_paths in spilled:
+            self._write(old_arrays, old_paths)
+        return tuple(pixels.astype(np.float32) for pixels in arrays)
+
+    def get(self, stage, frame):
+        with self._lock:
+            item = self._frames.get((stage, frame))
+        if item == None:
+            return None
+        return tuple(pixels.astype(np.float32) for pixels in item[0])
+
+    def contains(self, stage, frame):
+        with self._lock:
+            return (stage, frame) in self._frames
+
+    def keep_frames(self, frames):
+        self._kept_frames = set(frames)
+
+def _get_compositing_settings(scene):
+    compositing = scene.unity6way.compositing
+    return {
+        "extra": compositing.extra,
+        "lightmaps_emissive": _use_lightmaps_emissive(scene),
+        "lightmap_multiplier": compositing.lightmap_multiplier,
+        "extra_multiplier": compositing.extra_multiplier,
+        "premultiplied": compositing.premultiplied,
+    }
+
+def _composite_frame_files(settings, frame, lightmaps_path, emissive_path, output_paths, custom_extra):
+    # reads and writes files or the frame store only, safe to run from worker threads
+    width, height, channels = _read_exr(lightmaps_path)
+    values = _get_lightmap_values(channels)
+    match settings["extra"]:
+        case 'NONE':
+            extra = values["Alpha"]
+        case 'EMISSIVE' if settings["lightmaps_emissive"]:
+            emissive = _get_exr_layer(channels, "Emissive")
+            emissive[..., 3] = values["Alpha"]
+            extra = _premultiplied_to_straight(emissive)[..., :3].mean(axis=-1)
+        case 'EMISSIVE':
+            _width, _height, channels = _read_exr(emissive_path)
+            extra = _premultiplied_to_straight(_get_exr_rgba(channels))[..., :3].mean(axis=-1)
+        case 'CUSTOM':
+            extra = custom_extra
+    if extra.shape != (height, width):
+        raise _ExrError("Extra channel size does not match lightmaps size")
+
+    positive, negative = _composite_6way(values, extra, settings["lightmap_multiplier"], settings["extra_multiplier"], settings["premultiplied"])
+    if _frame_store != None:
+        return _frame_store.put('COMPOSITING', frame, (positive, negative), output_paths)
+    _write_exr_rgba(output_paths[0], positive)
+    _write_exr_rgba(output_paths[1], negative)
+    return positive, negative
+
+def _list_files(directory):
+    try:
+        with os.scandir(directory or ".") as entries:
+            return {os.path.normcase(entry.name) for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+def _check_exr_file(path, layers):
+    # header, offset table and block bounds only, no pixel data is decoded
+    try:
+        with open(path, 'rb') as file:
+            data = file.read(65536)
+            header = _parse_exr_header(data)
+            file_size = os.fstat(file.fileno()).st_size
+            width, height = _get_exr_size(header)
+            table_start = header['offset']
+            table_size = -(-height // _exr_lines_per_block[header['compression']]) * 8
+            table = data[table_start:table_start + table_size]
+            if len(table) < table_size:
+                file.seek(table_start)
+                table = file.read(table_size)
+            if len(table) < table_size:
+                raise _ExrError("Truncated OpenEXR file")
+            offsets = np.frombuffer(table, dtype='<u8')
+            #unwritten blocks of an interrupted render keep a zero offset
+            if (offsets < table_start + table_size).any() or (offsets + 8 > file_size).any():
+                raise _ExrError("Incomplete OpenEXR file")
+            last_offset = int(offsets.max())
+            file.seek(last_offset)
+            _y, size = struct.unpack('<ii', file.read(8))
+            if last_offset + 8 + size > file_size:
+                raise _ExrError("Truncated OpenEXR file")
+    except (OSError, struct.error, _ExrError) as error:
+        return None, str(error)
+
+    layer_names = {name.split('.')[-2] for name, _dtype in header['channels'] if '.' in name}
+    #a list holds alternative layer sets, the error names the layers missing from the first one
+    missing_layers = [[layer for layer in layer_set if layer not in layer_names] for layer_set in (layers if isinstance(layers, list) else [layers])]
+    if all(missing_layers):
+        return None, "Missing OpenEXR layers: " + ", ".join(missing_layers[0])
+    return (width, height), None
+
+def _validate_input_files(files):
+    # files are (path, layers) pairs, layers is None for files that are not OpenEXR
+    # returns the missing paths and (path, error) pairs of unreadable or mismatching files
+    files = dict(files)
+    listings = {}
+    missing_paths = []
+    exr_files = []
+    for path, layers in files.items():
+        directory, filename = os.path.split(path)
+        if directory not in listings:
+            listings[directory] = _list_files(directory)
+        if os.path.normcase(filename) not in listings[directory]:
+            missing_paths.append(path)
+        elif layers != None:
+            exr_files.append((path, layers))
+
+    invalid_files = []
+    sizes = {}
+    if exr_files:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(exr_files))) as executor:
+            results = executor.map(lambda file: _check_exr_file(*file), exr_files)
+            for (path, _layers), (size, error) in zip(exr_files, results):
+                if error != None:
+                    invalid_files.append((path, error))
+                else:
+                    sizes[path] = size
+
+    if sizes:
+        expected_size = collections.Counter(sizes.values()).most_common(1)[0][0]
+        for path, size in sizes.items():
+            if size != expected_size:
+                invalid_files.append((path, "Size {0}x{1} does not match {2}x{3}".format(*size, *expected_size)))
+    return missing_paths, invalid_files
+
+def _check_compositing_input_paths(scene, frames):
+    unity6way = scene.unity6way
+    extra = unity6way.compositing.extra
+
+    #files of both layouts are read, the current setting is only the expected one
+    lightmaps_layers = [_light_direction_names + ("Alpha",), tuple(_compact_lightmap_layers)]
+    if unity6way.lightmaps.compact:
+        lightmaps_layers.reverse()
+    if extra == 'EMISSIVE' and _use_lightmaps_emissive(scene):
+        lightmaps_layers = [layer_set + ("Emissive",) for layer_set in lightmaps_layers]
+
+    files = []
+    if extra == 'CUSTOM':
+        files.append((bpy.path.abspath(unity6way.compositing.custom_path), None)) #one custom image is used for every frame
+    for frame in frames:
+        files.append((_get_lightmaps_path(unity6way, frame), lightmaps_layers))
+        if extra == 'EMISSIVE' and not _use_lightmaps_emissive(scene):
+            files.append((_get_emissive_path(unity6way, frame), ()))
+
+    return _validate_input_files(files)
+
+def _load_custom_extra(unity6way, width, height):
+    image = _load_image(bpy.path.abspath(unity6way.compositing.custom_path))
+    image.scale(width, height)
+    pixels = _get_image_pixels(image)
+    if image.is_float:
+        _premultiplied_to_straight(pixels)
+    bpy.data.images.remove(image)
+    return pixels[..., :3].mean(axis=-1)
+
+def _check_flipbook_input_paths(unity6way, frames):
+    return _validate_input_files((path, ()) for frame in frames for path in _get_compositing_paths(unity6way, frame))
+
 def _show_image(path, alpha_mode):
+    if bpy.app.background:
+        return None
     image = _load_image(path)
     image.alpha_mode = alpha_mode
     bpy.ops.render.view_show('INVOKE_DEFAULT')
@@ -140,11 +1154,20 @@ def _show_image(path, alpha_mode):
     image_area.spaces.active.image = image
     return image_area
 
-def _report_missing_inputs(operator, missing_paths):
-    message = "Input image(s) not found: "
-    for missing_path in missing_paths:
-        message += "\n" + missing_path
-    operator.report({'WARNING'}, message)
+def _get_missing_inputs_message(missing_paths, invalid_files = ()):
+    lines = []
+    if missing_paths:
+        lines.append("Input image(s) not found: {0}".format(len(missing_paths)))
+        lines += missing_paths[:10]
+    if invalid_files:
+        lines.append("Input image(s) unreadable: {0}".format(len(invalid_files)))
+        lines += ["{0}: {1}".format(path, error) for path, error in invalid_files[:10]]
+    if len(missing_paths) > 10 or len(invalid_files) > 10:
+        lines.append("...")
+    return "\n".join(lines)
+
+def _report_missing_inputs(operator, missing_paths, invalid_files = ()):
+    operator.report({'WARNING'}, _get_missing_inputs_message(missing_paths, invalid_files))
 
 def _remove_compositor_node_group(group_name):
     if bpy.data.node_groups.__contains__(group_name):
@@ -268,14 +1291,1155 @@ def _destroy_compositor_nodes(tree, nodes):
         tree.nodes.remove(node)
 
 
+def _get_stage_output_paths(unity6way, stage, frame):
+    match stage:
+        case 'LIGHTMAPS':
+            return (_get_lightmaps_path(unity6way, frame),)
+        case 'EMISSIVE':
+            return (_get_emissive_path(unity6way, frame),)
+        case 'COMPOSITING':
+            return _get_compositing_paths(unity6way, frame)
+    return ()
+
+def _load_cache_manifest(unity6way):
+    try:
+        with open(_get_input_path(unity6way.temp_path, _cache_filename, "json")) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache_manifest(unity6way, manifest):
+    path = _get_input_path(unity6way.temp_path, _cache_filename, "json")
+    with open(path + ".tmp", 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def _update_cache_manifest(unity6way, stage, frames, frame_hashes):
+    # frames written without a hash are dropped so a stale entry never matches new content
+    manifest = _load_cache_manifest(unity6way)
+    entries = manifest.setdefault(stage, {})
+    for frame in frames:
+        if frame in frame_hashes:
+            entries[str(frame)] = frame_hashes[frame]
+        else:
+            entries.pop(str(frame), None)
+    try:
+        _save_cache_manifest(unity6way, manifest)
+    except OSError:
+        pass # the cache only saves time, frames are rendered again next run
+
+def _hash_value(hasher, value):
+    if isinstance(value, set):
+        value = sorted(value)
+    elif hasattr(value, "__len__") and not isinstance(value, str):
+        value = tuple(value)
+    hasher.update(repr(value).encode())
+
+def _hash_rna(hasher, struct, ignore=()):
+    for prop in struct.bl_rna.properties:
+        if prop.type in ('BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM') and prop.identifier != 'rna_type' and prop.identifier not in ignore:
+            try:
+                _hash_value(hasher, getattr(struct, prop.identifier))
+            except (AttributeError, TypeError, ValueError):
+                pass
+
+def _hash_id_properties(hasher, struct):
+    # custom properties, the inputs of a geometry nodes modifier among them, are not RNA properties
+    for key in struct.keys():
+        value = struct[key]
+        if hasattr(value, "to_dict"):
+            value = value.to_dict()
+        elif hasattr(value, "to_list"):
+            value = value.to_list()
+        elif isinstance(value, bpy.types.ID):
+            value = value.name_full
+        hasher.update(repr((key, value)).encode())
+
+def _hash_node_tree(hasher, tree, hashed_trees, frame):
+    if tree.name_full in hashed_trees:
+        return
+    hashed_trees.add(tree.name_full)
+    for node in tree.nodes:
+        hasher.update(node.bl_idname.encode())
+        _hash_rna(hasher, node, _node_ui_properties)
+        if node.bl_idname in _time_dependent_node_types:
+            _hash_value(hasher, frame)
+        for socket in node.inputs:
+            if hasattr(socket, "default_value"):
+                _hash_value(hasher, socket.default_value)
+            #geometry read from other objects and collections is not hashed here
+            if socket.type in ('OBJECT', 'COLLECTION'):
+                _hash_value(hasher, frame)
+            elif socket.type == 'IMAGE' and getattr(socket, "default_value", None) != None and socket.default_value.source in ('SEQUENCE', 'MOVIE'):
+                _hash_value(hasher, frame)
+        node_object = getattr(node, "object", None)
+        if isinstance(node_object, bpy.types.Object):
+            _hash_value(hasher, node_object.matrix_world)
+        image = getattr(node, "image", None)
+        if image != None:
+            _hash_value(hasher, (image.filepath, image.source))
+            if image.source in ('SEQUENCE', 'MOVIE'):
+                #the file path stays the same while the shown image follows the frame
+                _hash_value(hasher, frame)
+        if getattr(node, "node_tree", None) != None:
+            _hash_node_tree(hasher, node.node_tree, hashed_trees, frame)
+    for link in tree.links:
+        _hash_value(hasher, (link.from_node.name, link.from_socket.identifier, link.to_node.name, link.to_socket.identifier, link.is_muted))
+
+def _hash_object(hasher, object, hashed_trees, frame):
+    hasher.update(object.name_full.encode())
+    _hash_value(hasher, object.matrix_world)
+    match object.type:
+        case 'MESH':
+            vertices = object.data.vertices
+            positions = np.empty(len(vertices) * 3, dtype=np.float32)
+            vertices.foreach_get("co", positions)
+            hasher.update(positions.tobytes())
+            _hash_value(hasher, (len(object.data.polygons), len(object.data.edges)))
+        case 'VOLUME':
+            grids = object.data.grids
+            _hash_value(hasher, (object.data.filepath, grids.frame, grids.frame_filepath))
+            _hash_rna(hasher, object.data.render)
+            if not object.data.filepath:
+                #volumes generated by geometry nodes have no file that follows the frame
+                _hash_value(hasher, frame)
+        case 'POINTCLOUD' | 'CURVES':
+            for name in ("position", "radius"):
+                attribute = object.data.attributes.get(name)
+                if attribute != None:
+                    values = np.empty(len(attribute.data) * (3 if name == "position" else 1), dtype=np.float32)
+                    attribute.data.foreach_get("vector" if name == "position" else "value", values)
+                    hasher.update(values.tobytes())
+        case object_type if object_type not in _geometryless_object_types:
+            #legacy curves, surfaces, metaballs, text and grease pencil are not inspected
+            _hash_value(hasher, frame)
+    if len(object.particle_systems):
+        #particles move from frame to frame without changing the hashed data
+        _hash_value(hasher, frame)
+    for modifier in object.original.modifiers:
+        _hash_rna(hasher, modifier)
+        if modifier.type == 'NODES':
+            _hash_id_properties(hasher, modifier)
+            if modifier.node_group != None:
+                _hash_node_tree(hasher, modifier.node_group, hashed_trees, frame)
+        if modifier.type == 'FLUID' and modifier.fluid_type == 'DOMAIN':
+            #the domain mesh is the same box on every frame, each frame reads its own cache files,
+            #baked simulation data lives on disk, a re-bake shows up in the cache folders
+            _hash_value(hasher, frame)
+            domain = modifier.domain_settings
+            _hash_rna(hasher, domain)
+            cache_directory = bpy.path.abspath(domain.cache_directory)
+            for folder in ("", "data", "noise"):
+                path = os.path.join(cache_directory, folder)
+                if os.path.isdir(path):
+                    _hash_value(hasher, os.path.getmtime(path))
+    for slot in object.material_slots:
+        if slot.material != None and slot.material.node_tree != None:
+            hasher.update(slot.material.name_full.encode())
+            _hash_node_tree(hasher, slot.material.node_tree, hashed_trees, frame)
+
+def _get_content_hashes(context, frames):
+    # hash of the evaluated camera and render visible objects of each frame
+    scene = context.scene
+    frame_current = scene.frame_current
+    content_hashes = {}
+    for frame in frames:
+        scene.frame_set(frame)
+        depsgraph = context.evaluated_depsgraph_get()
+        hasher = hashlib.sha1()
+        if scene.camera != None:
+            _hash_value(hasher, scene.camera.evaluated_get(depsgraph).matrix_world)
+        hashed_trees = set()
+        for object in scene.objects:
+            #scene lights are always disabled during the render stages
+            if not object.hide_render and object.type not in ('LIGHT', 'CAMERA'):
+                _hash_object(hasher, object.evaluated_get(depsgraph), hashed_trees, frame)
+        for instance in depsgraph.object_instances:
+            if instance.is_instance:
+                hasher.update(instance.object.name_full.encode())
+                _hash_value(hasher, instance.matrix_world)
+        content_hashes[frame] = hasher.hexdigest()
+    scene.frame_set(frame_current)
+    return content_hashes
+
+def _get_render_hashes(context, stage, frames, content_hashes = None):
+    # hash of everything that changes the rendered pixels of each frame
+    scene = context.scene
+    unity6way = scene.unity6way
+
+    settings_hasher = hashlib.sha1(stage.encode())
+    for struct in (scene.render, getattr(scene, "cycles", None), getattr(scene, "eevee", None)):
+        if struct != None:
+            _hash_rna(settings_hasher, struct)
+    if stage == 'LIGHTMAPS':
+        _hash_rna(settings_hasher, unity6way.lightmaps)
+    _hash_value(settings_hasher, _get_render_resolution(scene, stage))
+    if scene.camera != None:
+        _hash_rna(settings_hasher, scene.camera.data)
+
+    if content_hashes == None:
+        content_hashes = _get_content_hashes(context, frames)
+    frame_hashes = {}
+    for frame in frames:
+        hasher = settings_hasher.copy()
+        _hash_value(hasher, (frame, content_hashes[frame]))
+        frame_hashes[frame] = hasher.hexdigest()
+    return frame_hashes
+
+def _get_compositing_hashes(scene, frames):
+    unity6way = scene.unity6way
+    manifest = _load_cache_manifest(unity6way)
+    settings_hasher = hashlib.sha1(b'COMPOSITING')
+    _hash_rna(settings_hasher, unity6way.compositing)
+    extra_stage = None
+    if unity6way.compositing.extra == 'EMISSIVE' and not _use_lightmaps_emissive(scene):
+        extra_stage = 'EMISSIVE'
+    elif unity6way.compositing.extra == 'CUSTOM':
+        custom_path = bpy.path.abspath(unity6way.compositing.custom_path)
+        _hash_value(settings_hasher, os.path.getmtime(custom_path) if _file_exists(custom_path) else None)
+
+    frame_hashes = {}
+    for frame in frames:
+        #compositing is up to date only when its inputs are
+        input_hashes = [manifest.get('LIGHTMAPS', {}).get(str(frame))]
+        if extra_stage != None:
+            input_hashes.append(manifest.get(extra_stage, {}).get(str(frame)))
+        if None in input_hashes:
+            continue
+        hasher = settings_hasher.copy()
+        _hash_value(hasher, input_hashes)
+        frame_hashes[frame] = hasher.hexdigest()
+    return frame_hashes
+
+def _get_stage_hashes(context, stage, frames, content_hashes = None):
+    if stage == 'COMPOSITING':
+        return _get_compositing_hashes(context.scene, frames)
+    return _get_render_hashes(context, stage, frames, content_hashes)
+
+def _get_file_hashes(frames, get_paths):
+    # files are only read when another frame has files of the same sizes
+    frame_sizes = {}
+    for frame in frames:
+        frame_sizes[frame] = tuple(os.path.getsize(path) if _file_exists(path) else None for path in get_paths(frame))
+    size_counts = collections.Counter(frame_sizes.values())
+    file_hashes = {}
+    for frame, sizes in frame_sizes.items():
+        if size_counts[sizes] < 2 or None in sizes:
+            #a frame number never equals a digest
+            file_hashes[frame] = frame
+            continue
+        hasher = hashlib.sha1()
+        for path in get_paths(frame):
+            with open(path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    hasher.update(chunk)
+        file_hashes[frame] = hasher.hexdigest()
+    return file_hashes
+
+def _get_duplicate_frames(frame_keys):
+    # frames with the same key as an earlier frame, mapped to that frame
+    first_frames = {}
+    duplicates = {}
+    for frame in sorted(frame_keys):
+        first_frame = first_frames.setdefault(frame_keys[frame], frame)
+        if first_frame != frame:
+            duplicates[frame] = first_frame
+    return duplicates
+
+def _get_compositing_input_paths(scene, frame):
+    unity6way = scene.unity6way
+    if unity6way.compositing.extra == 'EMISSIVE' and not _use_lightmaps_emissive(scene):
+        return (_get_lightmaps_path(unity6way, frame), _get_emissive_path(unity6way, frame))
+    return (_get_lightmaps_path(unity6way, frame),)
+
+def _split_duplicate_frames(context, stage, frames):
+    # render stages compare the evaluated scene, compositing its input files,
+    # returns the frames to process, the duplicates and the content hashes the cache can reuse
+    scene = context.scene
+    if stage == 'COMPOSITING':
+        content_hashes = None
+        duplicates = _get_duplicate_frames(_get_file_hashes(frames, lambda frame: _get_compositing_input_paths(scene, frame)))
+    else:
+        content_hashes = _get_content_hashes(context, frames)
+        duplicates = _get_duplicate_frames(content_hashes)
+    return [frame for frame in frames if frame not in duplicates], duplicates, content_hashes
+
+def _copy_duplicate_outputs(unity6way, stage, duplicates):
+    # copies rather than links, the files of a frame are overwritten in place when it is processed again
+    paths = []
+    for frame, first_frame in duplicates.items():
+        arrays = _frame_store.get(stage, first_frame) if _frame_store != None else None
+        if arrays != None:
+            _frame_store.put(stage, frame, arrays, _get_stage_output_paths(unity6way, stage, frame))
+            continue
+        for source_path, path in zip(_get_stage_output_paths(unity6way, stage, first_frame), _get_stage_output_paths(unity6way, stage, frame)):
+            if _file_exists(source_path):
+                shutil.copyfile(source_path, path)
+                paths.append(path)
+    _rescan_output_states(paths)
+    return paths
+
+def _filter_cached_frames(unity6way, stage, frames, frame_hashes):
+    entries = _load_cache_manifest(unity6way).get(stage, {})
+    outdated_frames = []
+    for frame in frames:
+        up_to_date = frame in frame_hashes and entries.get(str(frame)) == frame_hashes[frame]
+        if not up_to_date or not all(_file_exists(path) for path in _get_stage_output_paths(unity6way, stage, frame)):
+            outdated_frames.append(frame)
+    return outdated_frames
+
+class _WorkerScheduler:
+    # renders (stage, frames) jobs in background Blender processes, retrying failed jobs
+
+    def __init__(self, arguments, jobs, workers, retries, log_directory):
+        self._arguments = arguments
+        self._pending = [(stage, frames, 0) for stage, frames in jobs]
+        self._running = []
+        self._workers = workers
+        self._retries = retries
+        self._log_directory = log_directory
+        self.completed = []
+        self.failed = []
+        self.job_times = []
+
+    def _launch(self, job):
+        # returns None and records a failed job when the process cannot be started
+        stage, frames, attempt = job
+        log_path = _get_input_path(self._log_directory, "unity6way_worker_{0}_{1:04d}".format(stage.lower(), frames[0]), "log")
+        command = self._arguments + ["--stages", stage.lower(), "--frames", ",".join(str(frame) for frame in frames)]
+        log = None
+        try:
+            log = open(log_path, 'w')
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        except (OSError, ValueError) as error:
+            if log != None:
+                log.close()
+            print("Unable to start worker: " + str(error))
+            self.job_times.append({"stage": stage, "frames": [frames[0], frames[-1]], "attempt": attempt,
+                "returncode": None, "error": str(error), "seconds": 0})
+            self.failed.append((stage, frames))
+            return None
+        return (process, job, log, time.perf_counter())
+
+    def poll(self):
+        running = []
+        for process, job, log, start in self._running:
+            if process.poll() == None:
+                running.append((process, job, log, start))
+                continue
+            log.close()
+            stage, frames, attempt = job
+            self.job_times.append({"stage": stage, "frames": [frames[0], frames[-1]], "attempt": attempt,
+                "returncode": process.returncode, "seconds": round(time.perf_counter() - start, 4)})
+            if process.returncode == 0:
+                self.completed.append((stage, frames))
+            elif attempt < self._retries:
+                self._pending.append((stage, frames, attempt + 1))
+            else:
+                self.failed.append((stage, frames))
+        self._running = running
+
+        while self._pending and len(self._running) < self._workers:
+            launched = self._launch(self._pending.pop(0))
+            if launched != None:
+                self._running.append(launched)
+        return not self._running
+
+    def cancel(self):
+        for process, job, log, start in self._running:
+            process.terminate()
+            process.wait()
+            log.close()
+        self._running = []
+        self._pending = []
+
+class _RunReport:
+    # timings of a run, written to the temp folder as JSON when the outermost stage ends
+
+    def __init__(self, scene):
+        self._lock = threading.Lock()
+        self._stages = []
+        self.data = {
+            "blender": bpy.app.version_string,
+            "scene": scene.name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "stages": {},
+        }
+
+    def _get_stage_data(self, stage):
+        return self.data["stages"].setdefault(stage, {})
+
+    @property
+    def stage(self):
+        return self._stages[-1][0] if self._stages else "OTHER"
+
+    def add(self, name, value, stage = None):
+        with self._lock:
+            data = self._get_stage_data(stage or self.stage)
+            data[name] = data.get(name, 0) + value
+
+    def add_frame(self, frame, seconds):
+        with self._lock:
+            self._get_stage_data(self.stage).setdefault("frame_seconds", {})[str(frame)] = round(seconds, 4)
+
+    def add_jobs(self, stage, jobs):
+        with self._lock:
+            self._get_stage_data(stage).setdefault("jobs", []).extend(jobs)
+
+    def begin_stage(self, stage):
+        self._stages.append((stage, time.perf_counter()))
+
+    def end_stage(self, output_paths):
+        stage, start = self._stages.pop()
+        self.add("seconds", time.perf_counter() - start, stage)
+        for path in output_paths:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            self.add("bytes_written", size, stage)
+            with self._lock:
+                self._get_stage_data(stage).setdefault("file_bytes", {})[os.path.basename(path)] = size
+        return not self._stages
+
+    def write(self, unity6way):
+        if resource != None:
+            #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+            scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+            self.data["peak_memory_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+            self.data["peak_worker_memory_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+        for data in self.data["stages"].values():
+            for name, value in data.items():
+                if isinstance(value, float):
+                    data[name] = round(value, 4)
+        try:
+            with open(_get_input_path(unity6way.temp_path, _report_filename, "json"), 'w') as file:
+                json.dump(self.data, file, indent=1)
+        except OSError as error:
+            print("Unable to write run report: " + str(error))
+
+def _begin_report_stage(scene, stage):
+    # nested stages add to the report of the outermost one
+    global _run_report
+    if _run_report == None:
+        if _is_worker or not scene.unity6way.write_report:
+            return
+        _run_report = _RunReport(scene)
+    _run_report.begin_stage(stage)
+
+def _end_report_stage(scene, output_paths = ()):
+    global _run_report
+    if _run_report != None and _run_report.end_stage(output_paths):
+        _run_report.write(scene.unity6way)
+        _run_report = None
+
+@contextlib.contextmanager
+def _report_time(name):
+    start = time.perf_counter()
+    yield
+    if _run_report != None:
+        _run_report.add(name, time.perf_counter() - start)
+
+def _get_frames_output_paths(unity6way, stage, frames):
+    return [path for frame in frames for path in _get_stage_output_paths(unity6way, stage, frame)]
+
+def _get_emission_inputs(tree, key, visited_keys = None):
+    # (node tree, node name, strength input, color input) of the emission inputs of a node tree and of the groups it uses,
+    # the inputs of each tree are cached until the names or types of its nodes change
+    if visited_keys == None:
+        visited_keys = set()
+    if key in visited_keys:
+        return []
+    visited_keys.add(key)
+
+    signature = []
+    groups = []
+    for node in tree.nodes:
+        signature.append((node.name, node.bl_idname))
+        if getattr(node, "node_tree", None) != None:
+            groups.append(node.node_tree)
+    cached = _emission_index.get(key)
+    if cached != None and cached[0] == signature:
+        inputs = cached[1]
+    else:
+        inputs = []
+        for node in tree.nodes:
+            if node.bl_idname == 'ShaderNodeEmission':
+                strength_input = node.inputs.get("Strength")
+                color_input = node.inputs.get("Color")
+            else:
+                strength_input = node.inputs.get("Emission Strength")
+                color_input = node.inputs.get("Emission Color") or node.inputs.get("Emission")
+            if strength_input != None:
+                inputs.append((node.name, strength_input.identifier, color_input.identifier if color_input != None else None))
+        _emission_index[key] = (signature, inputs)
+
+    emission_inputs = [(tree,) + emission_input for emission_input in inputs]
+    for group in groups:
+        emission_inputs += _get_emission_inputs(group, ('GROUP', group.name_full), visited_keys)
+    return emission_inputs
+
+def _get_render_materials(scene):
+    materials = set()
+    for object in scene.objects:
+        if not object.hide_render:
+            for slot in object.material_slots:
+                if slot.material != None and slot.material.use_nodes and slot.material.node_tree != None:
+                    materials.add(slot.material)
+    return materials
+
+def _get_socket(sockets, identifier):
+    for socket in sockets:
+        if socket.identifier == identifier:
+            return socket
+    return None
+
+def _is_emitting(strength_input, color_input):
+    if strength_input.is_linked or strength_input.default_value != 0:
+        return color_input == None or color_input.is_linked or any(color_input.default_value[:3])
+    return False
+
+def _disable_emissive_materials(scene):
+    # only emitting inputs of materials the render uses are unlinked and zeroed, returns what restores them
+    restore_emissive_infos = []
+    #groups shared by several materials are visited once
+    visited_keys = set()
+    for material in _get_render_materials(scene):
+        for tree, node_name, strength_identifier, color_identifier in _get_emission_inputs(material.node_tree, ('MATERIAL', material.name_full), visited_keys):
+            node = tree.nodes.get(node_name)
+            if node == None:
+                continue
+            strength_input = _get_socket(node.inputs, strength_identifier)
+            color_input = _get_socket(node.inputs, color_identifier) if color_identifier != None else None
+            if strength_input == None or not _is_emitting(strength_input, color_input):
+                continue
+            from_socket = strength_input.links[0].from_socket if strength_input.is_linked else None
+            restore_emissive_infos.append((tree, node_name, strength_identifier, strength_input.default_value, from_socket))
+            if from_socket != None:
+                tree.links.remove(strength_input.links[0])
+            strength_input.default_value = 0
+    return restore_emissive_infos
+
+def _restore_emissive_materials(restore_emissive_infos):
+    for tree, node_name, strength_identifier, default_value, from_socket in restore_emissive_infos:
+        node = tree.nodes.get(node_name)
+        strength_input = _get_socket(node.inputs, strength_identifier) if node != None else None
+        if strength_input == None:
+            continue
+        strength_input.default_value = default_value
+        if from_socket != None:
+            tree.links.new(from_socket, strength_input)
+
+def _on_render_pre(scene):
+    global _frame_render_start
+    _frame_render_start = time.perf_counter()
+
 def _on_render_init(scene):
     scene.unity6way.is_rendering = True
 
 def _on_render_cancel(scene):
     scene.unity6way.is_rendering = False
+    scene.unity6way.is_cancelled = True
+    _continue_render()
 
 def _on_render_complete(scene):
     scene.unity6way.is_rendering = False
+    _continue_render()
+
+def _on_render_post(scene):
+    _rendered_frames.append(scene.frame_current)
+    if _active_overlap != None:
+        _active_overlap.submit(scene.unity6way, scene.frame_current)
+    if _active_render != None:
+        _rescan_output_states(_get_stage_output_paths(scene.unity6way, _active_render.stage, scene.frame_current))
+    if _run_report != None:
+        _run_report.add_frame(scene.frame_current, time.perf_counter() - _frame_render_start)
+
+def _continue_render():
+    #handlers run while the render job ends, continue once it has ended
+    if _active_render != None:
+        bpy.app.timers.register(_active_render.continue_render, first_interval=0)
+
+@bpy.app.handlers.persistent
+def _on_load_pre(*args):
+    global _active_render, _run_report, _overlapped_atlas, _frame_store
+    if _active_render != None:
+        _active_render.cancel()
+    _active_render = None
+    _run_report = None
+    _overlapped_atlas = None
+    _frame_store = None
+    if _active_overlap != None:
+        _active_overlap.cancel()
+    _emission_index.clear()
+    if _active_pipeline != None:
+        _active_pipeline.cancel(bpy.context.scene)
+
+class _RenderStage:
+    # renders the frames of a stage between its prepare and restore operators,
+    # the render handlers continue with the next frame and the restore
+
+    def __init__(self, prepare_operator, restore_operator, stage, on_finished = None):
+        self.prepare_operator = prepare_operator
+        self.restore_operator = restore_operator
+        self.stage = stage
+        self.is_up_to_date = False
+        self._on_finished = on_finished
+        self._window = None
+        self._scene = None
+        self._restore_frame_start = 0
+        self._restore_frame_end = 0
+        self._restore_frame_step = 1
+        self._restore_frame_current = 0
+        self._render_frames = []
+        self._frame_hashes = {}
+        self._duplicates = {}
+        self._restore_scene_info = {}
+        self._restore_world_info = {}
+        self._restore_nodes = []
+        self._restore_lights = []
+        self._restore_lock_interface = False
+
+    def _prepare(self, context, frames):
+        scene = context.scene
+        
+        scene.unity6way.is_cancelled = False
+        scene.unity6way.is_locked = True
+        self._restore_lock_interface = scene.render.use_lock_interface
+        scene.render.use_lock_interface = True
+
+        self._prepare_scene(scene)
+        self._prepare_world(scene.world)
+        self._prepare_frames_range(scene, frames)
+        self._disable_existing_nodes(scene.node_tree)
+        self._disable_existing_lights()
+
+        _restore_info = {}
+        with _report_time("prepare_operator_seconds"):
+            getattr(bpy.ops.render, self.prepare_operator)()
+
+        _rendered_frames.clear()
+        bpy.app.handlers.render_pre.append(_on_render_pre)
+        bpy.app.handlers.render_init.append(_on_render_init)
+        bpy.app.handlers.render_cancel.append(_on_render_cancel)
+        bpy.app.handlers.render_complete.append(_on_render_complete)
+        bpy.app.handlers.render_post.append(_on_render_post)
+
+    def _restore(self, context):
+        scene = context.scene
+        restore_start = time.perf_counter()
+
+        bpy.app.handlers.render_post.remove(_on_render_post)
+        bpy.app.handlers.render_complete.remove(_on_render_complete)
+        bpy.app.handlers.render_cancel.remove(_on_render_cancel)
+        bpy.app.handlers.render_init.remove(_on_render_init)
+        bpy.app.handlers.render_pre.remove(_on_render_pre)
+
+        getattr(bpy.ops.render, self.restore_operator)()
+        _restore_info = {}
+
+        self._restore_existing_lights()
+        self._restore_existing_nodes(scene.node_tree)
+        self._restore_frames_range(scene)
+        self._restore_world(scene.world)
+        self._restore_scene(scene)
+
+        scene.render.use_lock_interface = self._restore_lock_interface
+        scene.unity6way.is_locked = False
+
+        if self.stage and not _is_worker:
+            _update_cache_manifest(scene.unity6way, self.stage, _rendered_frames, self._frame_hashes)
+        #duplicates are only copied once every frame they repeat is written
+        if self._duplicates and not scene.unity6way.is_cancelled:
+            _rendered_frames.extend(self._duplicates)
+            _copy_duplicate_outputs(scene.unity6way, self.stage, self._duplicates)
+
+        if _run_report != None:
+            _run_report.add("restore_seconds", time.perf_counter() - restore_start)
+        _end_report_stage(scene, _get_frames_output_paths(scene.unity6way, self.stage, _rendered_frames))
+
+    def _prepare_frames_range(self, scene, frames):
+        self._restore_frame_start = scene.frame_start
+        self._restore_frame_end = scene.frame_end
+        self._restore_frame_step = scene.frame_step
+        self._restore_frame_current = scene.frame_current
+        frame_step = frames[1] - frames[0] if len(frames) > 1 else 1
+        scene.frame_start = frames[0]
+        scene.frame_end = frames[-1]
+        #evenly spaced frames render as a single animation, others one frame at a time
+        if all(next_frame - frame == frame_step for frame, next_frame in zip(frames, frames[1:])):
+            scene.frame_step = frame_step
+            self._render_frames = []
+        else:
+            scene.frame_step = 1
+            self._render_frames = frames
+
+    def _restore_frames_range(self, scene):
+        scene.frame_start = self._restore_frame_start
+        scene.frame_end = self._restore_frame_end
+        scene.frame_step = self._restore_frame_step
+        scene.frame_set(self._restore_frame_current)
+
+    def _prepare_scene(self, scene):
+        self._restore_scene_info = {}
+        self._restore_scene_info["use_nodes"] = scene.use_nodes
+        scene.use_nodes = True
+        self._restore_scene_info["film_transparent"] = scene.render.film_transparent
+        scene.render.film_transparent = True
+        self._restore_scene_info["exposure"] = scene.view_settings.exposure
+        scene.view_settings.exposure = 0
+        self._restore_scene_info["gamma"] = scene.view_settings.gamma
+        scene.view_settings.gamma = 2.2
+        self._restore_scene_info["view_transform"] = scene.view_settings.view_transform
+        scene.view_settings.view_transform = 'Raw'
+        render = scene.render
+        self._restore_scene_info["resolution"] = (render.resolution_x, render.resolution_y, render.resolution_percentage)
+        render.resolution_x, render.resolution_y = _get_render_resolution(scene, self.stage)
+        render.resolution_percentage = 100
+
+    def _restore_scene(self, scene):
+        scene.use_nodes = self._restore_scene_info["use_nodes"]
+        scene.render.film_transparent = self._restore_scene_info["film_transparent"]
+        scene.view_settings.exposure = self._restore_scene_info["exposure"]
+        scene.view_settings.gamma = self._restore_scene_info["gamma"]
+        scene.view_settings.view_transform = self._restore_scene_info["view_transform"]
+        render = scene.render
+        render.resolution_x, render.resolution_y, render.resolution_percentage = self._restore_scene_info["resolution"]
+        self._restore_scene_info = {}
+
+    def _prepare_world(self, world):
+        self._restore_world_info["use_nodes"] = world.use_nodes
+        world.use_nodes = False
+        self._restore_world_info["bg_color"] = world.color
+        world.color = [0, 0, 0]
+
+    def _restore_world(self, world):
+        world.use_nodes = self._restore_world_info["use_nodes"]
+        world.color = self._restore_world_info["bg_color"]
+
+    def _disable_existing_nodes(self, tree):
+        self._restore_nodes = []
+        for node in tree.nodes:
+            if not node.mute:
+                self._restore_nodes.append(node)
+                node.mute = True
+
+    def _restore_existing_nodes(self, tree):
+        for node in self._restore_nodes:
+            node.mute = False
+
+    def _disable_existing_lights(self):
+        self._restore_lights = []
+        for object in bpy.data.objects:
+            if object.type == 'LIGHT':
+                light_object = object
+                if not light_object.hide_render:
+                    self._restore_lights.append(light_object)
+                    light_object.hide_render = True
+
+    def _restore_existing_lights(self):
+        for light_object in self._restore_lights:
+            light_object.hide_render = False
+
+    def _render(self, context):
+        context.scene.unity6way.is_rendering = True
+        if self._render_frames:
+            context.scene.frame_set(self._render_frames.pop(0))
+            bpy.ops.render.render('INVOKE_DEFAULT')
+        else:
+            bpy.ops.render.render('INVOKE_DEFAULT', animation=True)
+
+    def _render_blocking(self, context):
+        if self._render_frames:
+            for frame in self._render_frames:
+                context.scene.frame_set(frame)
+                bpy.ops.render.render('EXEC_DEFAULT')
+            self._render_frames = []
+        else:
+            bpy.ops.render.render('EXEC_DEFAULT', animation=True)
+
+    def _finish(self, context):
+        global _active_render
+        _active_render = None
+        self._restore(context)
+        if self._on_finished != None:
+            self._on_finished(context)
+
+    def cancel(self):
+        #the prepared scene is discarded with the file being unloaded, so it is not restored,
+        #the render handlers and timers are not persistent and the load removes them
+        _restore_info.clear()
+        self._render_frames = []
+        if self._scene != None:
+            self._scene.unity6way.is_cancelled = True
+            _end_report_stage(self._scene)
+
+    def continue_render(self):
+        with bpy.context.temp_override(window=self._window, scene=self._scene):
+            context = bpy.context
+            if self._render_frames and not context.scene.unity6way.is_cancelled:
+                self._render(context)
+            else:
+                self._finish(context)
+        #run once
+        return None
+
+    def start(self, context):
+        global _active_render
+        scene = context.scene
+        unity6way = scene.unity6way
+
+        _begin_report_stage(scene, self.stage or self.prepare_operator)
+
+        frames = _get_render_frames(scene)
+        self._duplicates = {}
+        content_hashes = None
+        if unity6way.reuse_duplicate_frames and self.stage and not _is_worker:
+            with _report_time("duplicate_seconds"):
+                frames, self._duplicates, content_hashes = _split_duplicate_frames(context, self.stage, frames)
+        self._frame_hashes = {}
+        if unity6way.use_cache and self.stage:
+            with _report_time("hash_seconds"):
+                self._frame_hashes = _get_stage_hashes(context, self.stage, frames, content_hashes)
+            frames = _filter_cached_frames(unity6way, self.stage, frames, self._frame_hashes)
+            if not frames:
+                self.is_up_to_date = True
+                _copy_duplicate_outputs(unity6way, self.stage, self._duplicates)
+                _end_report_stage(scene)
+                return {'FINISHED'}
+
+        #the report stage is closed by the restore, or here when the prepare operator fails
+        prepared = False
+        try:
+            with _report_time("prepare_seconds"):
+                self._prepare(context, frames)
+            prepared = True
+        finally:
+            if not prepared:
+                _end_report_stage(scene)
+
+        if bpy.app.background:
+            try:
+                self._render_blocking(context)
+            finally:
+                self._restore(context)
+            return {'CANCELLED'} if unity6way.is_cancelled else {'FINISHED'}
+
+        self._window = context.window
+        self._scene = scene
+        _active_render = self
+        self._render(context)
+        return {'RUNNING_MODAL'}
+
+class _OverlappedCompositor:
+    # composites each lightmap frame in background threads as soon as it is rendered and places its
+    # flipbook tiles in an atlas, while the next frame renders
+
+    def __init__(self, scene):
+        unity6way = scene.unity6way
+        flipbook = unity6way.flipbook
+        self._settings = _get_compositing_settings(scene)
+        self._custom_extra = None
+        if self._settings["extra"] == 'CUSTOM':
+            width, height = _get_render_resolution(scene, 'LIGHTMAPS')
+            self._custom_extra = _load_custom_extra(unity6way, width, height)
+        self._futures = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+        #the flipbook export assembles shared, streamed and Blender scaled tiles itself
+        self.tiles = None
+        self._atlas = None
+        self._tile_positions = {}
+        if flipbook.enabled and not flipbook.share_duplicates and not flipbook.streaming and flipbook.filter != 'BLENDER':
+            self.tiles = _get_flipbook_tiles(_get_flipbook_frames(scene), flipbook.tiling)
+            self._atlas = np.zeros((2, flipbook.image_size[1], flipbook.image_size[0], 4), dtype=np.float32)
+            for tile_x, tile_y, frame in self.tiles:
+                self._tile_positions.setdefault(frame, []).append((tile_x, tile_y))
+            self._tile_size = (flipbook.image_size[0] // flipbook.tiling[0], flipbook.image_size[1] // flipbook.tiling[1])
+            self._padding = _get_tile_padding(flipbook)
+            self._frame_size = (self._tile_size[0] - 2 * self._padding, self._tile_size[1] - 2 * self._padding)
+            self._filter = flipbook.filter
+            self._premultiplied = unity6way.compositing.premultiplied
+
+    def _place_tiles(self, frame, pair):
+        pair = _pad_tile_pair(pair, self._padding)
+        for tile_x, tile_y in self._tile_positions.get(frame, ()):
+            for i in range(2):
+                _get_tile_view(self._atlas[i], tile_x, tile_y, *self._tile_size)[...] = pair[i]
+
+    def _composite(self, frame, lightmaps_path, emissive_path, output_paths):
+        pair = _composite_frame_files(self._settings, frame, lightmaps_path, emissive_path, output_paths, self._custom_extra)
+        if frame in self._tile_positions:
+            #the export reads the half float files, the tiles match it
+            pair = [pixels.astype(np.float16).astype(np.float32) for pixels in pair]
+            self._place_tiles(frame, _resample_tile_pair(pair[0], pair[1], *self._frame_size, self._filter, self._premultiplied))
+
+    def _load_tiles(self, frame, input_paths):
+        self._place_tiles(frame, _load_tile_pair(input_paths, *self._frame_size, self._filter, self._premultiplied, frame))
+
+    def _get_paths(self, unity6way, frame):
+        return (_get_lightmaps_path(unity6way, frame), _get_emissive_path(unity6way, frame), _get_compositing_paths(unity6way, frame))
+
+    def submit(self, unity6way, frame):
+        if frame not in self._futures:
+            self._futures[frame] = self._executor.submit(self._composite, frame, *self._get_paths(unity6way, frame))
+
+    def finish(self, context):
+        # composites the frames that were not rendered, returns an error message or None
+        global _active_overlap, _overlapped_atlas
+        _active_overlap = None
+        scene = context.scene
+        unity6way = scene.unity6way
+        frames = _get_render_frames(scene)
+
+        _begin_report_stage(scene, 'COMPOSITING')
+        completed_frames = []
+        error = None
+        try:
+            frame_hashes = {}
+            outdated_frames = frames
+            if unity6way.use_cache:
+                with _report_time("hash_seconds"):
+                    frame_hashes = _get_compositing_hashes(scene, frames)
+                outdated_frames = _filter_cached_frames(unity6way, 'COMPOSITING', frames, frame_hashes)
+            remaining_frames = [frame for frame in outdated_frames if frame not in self._futures]
+            if _run_report != None:
+                _run_report.add("overlapped_frames", len(self._futures))
+
+            missing_paths, invalid_files = _check_compositing_input_paths(scene, remaining_frames)
+            if missing_paths or invalid_files:
+                self.cancel()
+                return _get_missing_inputs_message(missing_paths, invalid_files)
+
+            for frame in remaining_frames:
+                self.submit(unity6way, frame)
+            with _report_time("wait_seconds"):
+                for frame, future in self._futures.items():
+                    try:
+                        future.result()
+                    except (_ExrError, OSError):
+                        #the lightmap file may still have been written when the frame was handed over
+                        try:
+                            self._composite(frame, *self._get_paths(unity6way, frame))
+                        except (_ExrError, OSError) as exception:
+                            error = str(exception)
+                            continue
+                    completed_frames.append(frame)
+
+            if self._atlas is not None and error == None:
+                loads = [self._executor.submit(self._load_tiles, frame, _get_compositing_paths(unity6way, frame))
+                    for frame in self._tile_positions.keys() - set(completed_frames)]
+                try:
+                    for future in loads:
+                        future.result()
+                    _overlapped_atlas = (self.tiles, self._atlas)
+                except (_ExrError, OSError):
+                    pass # the flipbook export loads the tiles and reports the files it cannot read
+        finally:
+            self._executor.shutdown()
+            _update_cache_manifest(unity6way, 'COMPOSITING', completed_frames, frame_hashes)
+            output_paths = _get_frames_output_paths(unity6way, 'COMPOSITING', completed_frames)
+            _end_report_stage(scene, output_paths)
+            _rescan_output_states(output_paths)
+        return error
+
+    def cancel(self):
+        global _active_overlap
+        if _active_overlap == self:
+            _active_overlap = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+class _RenderPipeline:
+    # runs the stages in order, stages rendering in the background continue it when they finish
+
+    def __init__(self, stages, worker_stages):
+        self._stages = stages
+        self._stage_index = 0
+        self._worker_stages = worker_stages
+        self._worker_hashes = {}
+        self._worker_duplicates = {}
+        self._scheduler = None
+        self._overlap = None
+        self._window = None
+        self._scene = None
+        self.error = None
+
+    def _start_workers(self, context):
+        scene = context.scene
+        unity6way = scene.unity6way
+
+        #workers render a copy of the current state of the file
+        blend_path = _get_input_path(unity6way.temp_path, "unity6way_worker", "blend")
+        bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True, check_existing=False)
+
+        threads = unity6way.worker_threads or max(1, os.cpu_count() // unity6way.workers)
+        arguments = [bpy.app.binary_path, "-b", blend_path, "-t", str(threads), "-P", os.path.abspath(__file__),
+            "--", "--worker", "--scene", scene.name, "--temp-path", unity6way.temp_path]
+
+        jobs = []
+        self._worker_hashes = {}
+        #both stages render the same objects, duplicates are found once
+        render_frames = _get_render_frames(scene)
+        self._worker_duplicates = {}
+        content_hashes = None
+        if unity6way.reuse_duplicate_frames:
+            render_frames, self._worker_duplicates, content_hashes = _split_duplicate_frames(context, 'LIGHTMAPS', render_frames)
+        for stage in self._worker_stages:
+            frames = render_frames
+            if unity6way.use_cache:
+                self._worker_hashes[stage] = _get_stage_hashes(context, stage, frames, content_hashes)
+                frames = _filter_cached_frames(unity6way, stage, frames, self._worker_hashes[stage])
+            chunk_size = max(1, -(-len(frames) // unity6way.workers))
+            for i in range(0, len(frames), chunk_size):
+                jobs.append((stage, frames[i:i + chunk_size]))
+
+        self._scheduler = _WorkerScheduler(arguments, jobs, unity6way.workers, unity6way.worker_retries, unity6way.temp_path)
+        self._scheduler.poll()
+        return {'RUNNING_MODAL'}
+
+    def _finish_workers(self, context):
+        unity6way = context.scene.unity6way
+        for stage, frames in self._scheduler.completed:
+            _update_cache_manifest(unity6way, stage, frames, self._worker_hashes.get(stage, {}))
+            _rescan_output_states(_get_frames_output_paths(unity6way, stage, frames))
+        if _run_report != None:
+            _run_report.add_jobs('WORKERS', self._scheduler.job_times)
+            _run_report.add("bytes_written", sum(os.path.getsize(path) for stage, frames in self._scheduler.completed
+                for path in _get_frames_output_paths(unity6way, stage, frames) if os.path.exists(path)), 'WORKERS')
+        failed = self._scheduler.failed
+        self._scheduler = None
+        if failed:
+            unity6way.is_cancelled = True
+            frames = ", ".join("{0} {1}-{2}".format(stage.lower(), frames[0], frames[-1]) for stage, frames in failed)
+            self.error = "Worker render failed for " + frames
+            return {'CANCELLED'}
+        for stage in self._worker_stages:
+            _copy_duplicate_outputs(unity6way, stage, self._worker_duplicates)
+        return {'FINISHED'}
+
+    def _poll_workers(self):
+        if self._scheduler == None:
+            return None
+        if not self._scheduler.poll():
+            return 0.5
+        with bpy.context.temp_override(window=self._window, scene=self._scene):
+            self._finish_workers(bpy.context)
+            self._run_next_stages(bpy.context)
+        return None
+
+    def _run_stage(self, context, stage):
+        global _active_overlap
+        match stage:
+            case 'TRIM':
+                result = bpy.ops.render.unity_6way_trim()
+                if _frame_store != None:
+                    #the flipbook frames follow the visible range
+                    _frame_store.keep_frames(_get_flipbook_frames(context.scene))
+                return result
+            case 'LIGHTMAPS':
+                if 'COMPOSITING' in self._stages and _use_overlap(context.scene):
+                    self._overlap = _OverlappedCompositor(context.scene)
+                    _active_overlap = self._overlap
+                return _RenderStage("unity_6way_lightmap_prepare", "unity_6way_lightmap_restore", 'LIGHTMAPS', self._run_next_stages).start(context)
+            case 'EMISSIVE':
+                return _RenderStage("unity_6way_emissive_prepare", "unity_6way_emissive_restore", 'EMISSIVE', self._run_next_stages).start(context)
+            case 'COMPOSITING':
+                if self._overlap != None:
+                    overlap, self._overlap = self._overlap, None
+                    self.error = overlap.finish(context)
+                    return {'CANCELLED'} if self.error != None else {'FINISHED'}
+                if _use_direct_compositing(context.scene):
+                    return bpy.ops.render.unity_6way_compositing_direct()
+                return _RenderStage("unity_6way_compositing_prepare", "unity_6way_compositing_restore", 'COMPOSITING', self._run_next_stages).start(context)
+            case 'FLIPBOOK':
+                return bpy.ops.render.unity_6way_flipbook_export()
+            case 'WORKERS':
+                result = self._start_workers(context)
+                if not bpy.app.background:
+                    bpy.app.timers.register(self._poll_workers, first_interval=0.5)
+                return result
+
+    def _start_frame_store(self, scene):
+        global _frame_store
+        unity6way = scene.unity6way
+        if 'COMPOSITING' in self._stages and _use_memory_handoff(scene):
+            #files are still written for the cache and for debugging, only the flipbook frames are kept
+            _frame_store = _FrameStore(unity6way.memory_limit * 1024 * 1024, unity6way.use_cache or _compositor_debug, _get_flipbook_frames(scene))
+
+    def _release_stage_data(self):
+        global _overlapped_atlas, _frame_store
+        if self._overlap != None:
+            self._overlap.cancel()
+            self._overlap = None
+        _overlapped_atlas = None
+        if _frame_store != None and _run_report != None:
+            _run_report.add("spilled_frames", _frame_store.spilled_frames, 'ALL')
+        _frame_store = None
+
+    def _run_next_stages(self, context):
+        global _active_pipeline
+        while self._stage_index < len(self._stages) and not context.scene.unity6way.is_cancelled:
+            stage = self._stages[self._stage_index]
+            self._stage_index += 1
+            result = self._run_stage(context, stage)
+            if result == {'CANCELLED'}:
+                context.scene.unity6way.is_cancelled = True
+            elif result == {'RUNNING_MODAL'}:
+                return
+
+        _active_pipeline = None
+        self._release_stage_data()
+        _end_report_stage(context.scene)
+        if self.error != None:
+            _report_error(context, self.error)
+
+    def run(self, context):
+        global _active_pipeline
+        self._window = context.window
+        self._scene = context.scene
+        _active_pipeline = self
+        _begin_report_stage(context.scene, 'ALL')
+        self._start_frame_store(context.scene)
+        self._run_next_stages(context)
+
+    def run_blocking(self, context):
+        _begin_report_stage(context.scene, 'ALL')
+        self._start_frame_store(context.scene)
+        result = {'FINISHED'}
+        try:
+            for stage in self._stages:
+                result = self._run_stage(context, stage)
+                if stage == 'WORKERS':
+                    while not self._scheduler.poll():
+                        time.sleep(0.5)
+                    result = self._finish_workers(context)
+                if result == {'CANCELLED'} or context.scene.unity6way.is_cancelled:
+                    result = {'CANCELLED'}
+                    break
+        finally:
+            self._release_stage_data()
+            _end_report_stage(context.scene)
+        return result
+
+    def cancel(self, scene):
+        global _active_pipeline
+        if self._scheduler != None:
+            self._scheduler.cancel()
+            self._scheduler = None
+            #a running render stage ends the report when it finishes, the workers do not
+            _end_report_stage(scene)
+        self._release_stage_data()
+        scene.unity6way.is_cancelled = True
+        _active_pipeline = None
+
+def _report_error(context, message):
+    #popups are not shown without a window
+    if bpy.app.background:
+        print(message)
+    if context.window_manager != None:
+        def draw(menu, context):
+            menu.layout.label(text=message)
+        context.window_manager.popup_menu(draw, title="6-Way lighting", icon='ERROR')
 
 class Unity6Way:
     
@@ -301,7 +2465,42 @@ class Unity6Way:
             row.enabled = unity6way.frames == 'RANGE'
             row.prop(unity6way, "frame_end")
 
-            self.layout.operator(Unity6Way.RenderAllOperator.bl_idname)
+            row = self.layout.row()
+            row.prop(unity6way, "trim_empty_frames")
+            sub = row.row()
+            sub.enabled = unity6way.trim_empty_frames
+            sub.prop(unity6way, "trim_flipbook")
+            if unity6way.trim_empty_frames:
+                row = self.layout.row()
+                frame_start, frame_end = _get_frames_range(scene)
+                if (frame_start, frame_end) != _get_full_frames_range(scene):
+                    row.label(text="Visible frames {0}-{1}".format(frame_start, frame_end))
+                row.operator(Unity6Way.TrimOperator.bl_idname)
+            self.layout.prop(unity6way, "flipbook_frames_only")
+            row = self.layout.row()
+            row.prop(unity6way, "auto_resolution")
+            sub = row.row()
+            sub.enabled = unity6way.auto_resolution
+            sub.prop(unity6way, "supersampling")
+            self.layout.prop(unity6way, "use_cache")
+            self.layout.prop(unity6way, "reuse_duplicate_frames")
+            self.layout.prop(unity6way, "overlap_stages")
+            row = self.layout.row()
+            row.prop(unity6way, "memory_handoff")
+            sub = row.row()
+            sub.enabled = unity6way.memory_handoff
+            sub.prop(unity6way, "memory_limit")
+            self.layout.prop(unity6way, "write_report")
+            self.layout.prop(unity6way, "workers")
+            row = self.layout.row()
+            row.enabled = unity6way.workers > 1
+            row.prop(unity6way, "worker_threads")
+            row.prop(unity6way, "worker_retries")
+
+            if _active_pipeline != None:
+                self.layout.operator(Unity6Way.CancelOperator.bl_idname)
+            else:
+                self.layout.operator(Unity6Way.RenderAllOperator.bl_idname)
 
     class Lightmaps:
 
@@ -322,6 +2521,31 @@ class Unity6Way:
                 min = 0,
                 max = 90
             )
+            use_lightgroups: bpy.props.BoolProperty(
+                name = "Single pass",
+                description = "Render the six lights in a single pass using light groups (Cycles only)",
+                default = True,
+            )
+            include_emissive: bpy.props.BoolProperty(
+                name = "Include emissive",
+                description = "Capture emission as an extra layer of the lightmap files instead of a separate emissive render (requires single pass)",
+                default = False,
+            )
+            compact: bpy.props.BoolProperty(
+                name = "Luminance only",
+                description = "Store one channel per light direction and a single alpha channel in two layers instead of seven RGBA layers",
+                default = False,
+            )
+            exr_codec: bpy.props.EnumProperty(
+                name = "Compression",
+                description = "OpenEXR compression of the lightmap files",
+                items = {
+                    ('ZIP', "ZIP", "Lossless, composited directly", 0),
+                    ('PIZ', "PIZ", "Lossless wavelet compression, smaller for noisy renders, composited through Blender", 1),
+                    ('DWAA', "DWAA", "Lossy compression, smallest files, composited through Blender", 2),
+                },
+                default = 'ZIP',
+            )
 
         class Panel(bpy.types.Panel):
             bl_idname = "VIEW3D_PT_unity_6way_lightmaps"
@@ -339,12 +2563,19 @@ class Unity6Way:
                 unity6way = scene.unity6way
                 self.layout.prop(unity6way.lightmaps, "filename")
                 self.layout.prop(unity6way.lightmaps, "light_angle")                
+                self.layout.prop(unity6way.lightmaps, "use_lightgroups")
+                row = self.layout.row()
+                row.enabled = unity6way.lightmaps.use_lightgroups
+                row.prop(unity6way.lightmaps, "include_emissive")
+                self.layout.prop(unity6way.lightmaps, "compact")
+                self.layout.prop(unity6way.lightmaps, "exr_codec", expand=True)
                 render_operator = self.layout.operator(Unity6Way.RenderUndoOperator.bl_idname)
                 render_operator.prepare_operator = "unity_6way_lightmap_prepare"
                 render_operator.restore_operator = "unity_6way_lightmap_restore"
+                render_operator.stage = 'LIGHTMAPS'
                 row = self.layout.row()
                 dest_path = _get_lightmaps_path(unity6way, _get_current_frame(scene))
-                row.enabled = _file_exists(dest_path)
+                row.enabled = _output_exists(dest_path)
                 row.operator(Unity6Way.Lightmaps.ViewResultOperator.bl_idname)
 
         class PrepareOperator(bpy.types.Operator):
@@ -399,67 +2630,116 @@ class Unity6Way:
                     view_layers[dir_name] = layer
                 _restore_info["view_layers"] = view_layers
 
-            def create_compositor_nodes(self, tree, output_path):
-                layer_nodes = {}
+            def create_lightgroups(self, scene_layers, use_emissive):
+                #single layer with every light collection, one light group per light
+                layer = scene_layers.new(self.__name_prefix)
+                layer.use_pass_emit = use_emissive
+                lights = _restore_info["lights"]
                 for dir_name in _light_direction_names:
+                    layer.lightgroups.add(name=self.__name_prefix+dir_name)
+                    lights[dir_name].lightgroup = self.__name_prefix+dir_name
+                _restore_info["view_layers"] = {"": layer}
+
+            def disable_other_layers(self, scene_layers):
+                view_layers = _restore_info["view_layers"].values()
+                disabled_layers = []
+                for layer in scene_layers:
+                    if layer.use and layer not in view_layers:
+                        layer.use = False
+                        disabled_layers.append(layer)
+                _restore_info["disabled_layers"] = disabled_layers
+
+            def create_compositor_nodes(self, tree, output_path, use_lightgroups, use_emissive, compact, exr_codec):
+                layer_nodes = {}
+                layer_outputs = {}
+                emissive_output = None
+                if use_lightgroups:
                     layer_node = tree.nodes.new(type='CompositorNodeRLayers')
-                    layer_node.layer = self.__name_prefix+dir_name
-                    layer_nodes[dir_name] = layer_node
+                    layer_node.layer = self.__name_prefix
+                    layer_node.location = (-3 * _node_separation[0], 0)
+                    layer_nodes[""] = layer_node
+                    for dir_name in _light_direction_names:
+                        layer_outputs[dir_name] = layer_node.outputs["Combined_"+self.__name_prefix+dir_name]
+                    alpha_output = layer_node.outputs["Alpha"]
+                    if use_emissive:
+                        emissive_output = layer_node.outputs["Emit"]
+                else:
+                    for dir_name in _light_direction_names:
+                        layer_node = tree.nodes.new(type='CompositorNodeRLayers')
+                        layer_node.layer = self.__name_prefix+dir_name
+                        layer_nodes[dir_name] = layer_node
+                        layer_outputs[dir_name] = layer_node.outputs["Image"]
+                    alpha_output = layer_nodes[_light_direction_names[0]].outputs["Alpha"]
+
+                    layer_nodes["Left"  ].location = (-4 * _node_separation[0], 4 * _node_separation[1])
+                    layer_nodes["Right" ].location = (-2 * _node_separation[0], 4 * _node_separation[1])
+                    layer_nodes["Bottom"].location = (-4 * _node_separation[0], 0)
+                    layer_nodes["Top"   ].location = (-2 * _node_separation[0], 0)
+                    layer_nodes["Front" ].location = (-4 * _node_separation[0], -4 * _node_separation[1])
+                    layer_nodes["Back"  ].location = (-2 * _node_separation[0], -4 * _node_separation[1])
 
                 output_node = _create_compositor_node_exr_multilayer_output(tree)
                 output_node.base_path = output_path
+                output_node.format.exr_codec = exr_codec
 
                 output_node.file_slots.remove(output_node.inputs[0])
 
-                for dir_name in _light_direction_names:
-                    output_node.file_slots.new(dir_name)
-                    tree.links.new(layer_nodes[dir_name].outputs["Image"], output_node.inputs[dir_name])
+                pack_nodes = []
+                if compact:
+                    location_y = 2 * _node_separation[1]
+                    for layer_name, names in _compact_lightmap_layers.items():
+                        combine_node = tree.nodes.new(type='CompositorNodeCombRGBA')
+                        combine_node.location = (-_node_separation[0], location_y)
+                        pack_nodes.append(combine_node)
+                        for socket, name in zip(combine_node.inputs, names):
+                            if name == "Alpha":
+                                tree.links.new(alpha_output, socket)
+                            elif name != None:
+                                bw_node = tree.nodes.new(type='CompositorNodeRGBToBW')
+                                bw_node.location = (-2 * _node_separation[0], location_y)
+                                pack_nodes.append(bw_node)
+                                tree.links.new(layer_outputs[name], bw_node.inputs["Image"])
+                                tree.links.new(bw_node.outputs["Val"], socket)
+                        output_node.file_slots.new(layer_name)
+                        tree.links.new(combine_node.outputs["Image"], output_node.inputs[layer_name])
+                        location_y -= 4 * _node_separation[1]
+                else:
+                    for dir_name in _light_direction_names:
+                        output_node.file_slots.new(dir_name)
+                        tree.links.new(layer_outputs[dir_name], output_node.inputs[dir_name])
 
-                output_node.file_slots.new("Alpha")
-                tree.links.new(layer_nodes[_light_direction_names[0]].outputs["Alpha"], output_node.inputs["Alpha"])
+                    output_node.file_slots.new("Alpha")
+                    tree.links.new(alpha_output, output_node.inputs["Alpha"])
 
-                layer_nodes["Left"  ].location = (-4 * _node_separation[0], 4 * _node_separation[1])
-                layer_nodes["Right" ].location = (-2 * _node_separation[0], 4 * _node_separation[1])
-                layer_nodes["Bottom"].location = (-4 * _node_separation[0], 0)
-                layer_nodes["Top"   ].location = (-2 * _node_separation[0], 0)
-                layer_nodes["Front" ].location = (-4 * _node_separation[0], -4 * _node_separation[1])
-                layer_nodes["Back"  ].location = (-2 * _node_separation[0], -4 * _node_separation[1])
+                if emissive_output != None:
+                    output_node.file_slots.new("Emissive")
+                    tree.links.new(emissive_output, output_node.inputs["Emissive"])
 
                 nodes = []
                 for layer_node in layer_nodes.values():
                     nodes.append(layer_node)
+                nodes += pack_nodes
                 nodes.append(output_node)
                 _restore_info["nodes"] = nodes
 
-            def disable_emissive_materials(self):
-                restore_emissive_infos = []
-                for material in bpy.data.materials:
-                    if material.use_nodes:
-                        zero_value_node = material.node_tree.nodes.new(type='ShaderNodeValue')
-                        zero_value_node.outputs[0].default_value = 0
-
-                        socket_pairs = []
-                        for node in material.node_tree.nodes:
-                            emission_input = None
-                            if node.type == 'ShaderNodeEmission':
-                                emission_input = node.inputs["Strength"]
-                            elif node.inputs.__contains__("Emission Strength"):
-                                emission_input = node.inputs["Emission Strength"]
-                            if emission_input != None:
-                                if emission_input.is_linked:
-                                    socket_pairs.append((emission_input.links[0].from_socket, emission_input))
-                                material.node_tree.links.new(zero_value_node.outputs[0], emission_input)
-
-                        restore_emissive_infos.append((material, zero_value_node, socket_pairs))
-                _restore_info["emissive_materials"] = restore_emissive_infos
-
             def execute(self, context):
                 scene = context.scene
                 unity6way = scene.unity6way
+                use_lightgroups = _use_lightgroups(scene)
+                use_emissive = _use_lightmaps_emissive(scene)
                 self.create_lights(scene.collection, scene.camera, unity6way.lightmaps.light_angle)
-                self.create_layers(scene.view_layers)
-                self.create_compositor_nodes(scene.node_tree, unity6way.temp_path+"\\"+unity6way.lightmaps.filename)
-                self.disable_emissive_materials()
+                if use_lightgroups:
+                    self.create_lightgroups(scene.view_layers, use_emissive)
+                else:
+                    self.create_layers(scene.view_layers)
+                self.disable_other_layers(scene.view_layers)
+                self.create_compositor_nodes(scene.node_tree, unity6way.temp_path+"\\"+unity6way.lightmaps.filename, use_lightgroups, use_emissive,
+                    unity6way.lightmaps.compact, unity6way.lightmaps.exr_codec)
+                if use_lightgroups:
+                    #emission is not part of the light group passes, materials are left untouched
+                    _restore_info["emissive_materials"] = []
+                else:
+                    _restore_info["emissive_materials"] = _disable_emissive_materials(scene)
                 return {'FINISHED'}     
 
         class RestoreOperator(bpy.types.Operator):
@@ -480,21 +2760,17 @@ class Unity6Way:
                 for layer in view_layers.values():
                     scene_layers.remove(layer)
 
-            def restore_emissive_materials(self, restore_emissive_infos):
-                for restore_emissive_info in restore_emissive_infos:
-                    material = restore_emissive_info[0]
-                    zero_value_node = restore_emissive_info[1]
-                    socket_pairs = restore_emissive_info[2]
-                    material.node_tree.nodes.remove(zero_value_node)
-                    for socket_pair in socket_pairs:
-                        material.node_tree.links.new(socket_pair[0], socket_pair[1])
+            def restore_other_layers(self, disabled_layers):
+                for layer in disabled_layers:
+                    layer.use = True
 
             def execute(self, context):
                 scene = context.scene
                 unity6way = scene.unity6way
-                self.restore_emissive_materials(_restore_info["emissive_materials"])
+                _restore_emissive_materials(_restore_info["emissive_materials"])
                 _destroy_compositor_nodes(scene.node_tree, _restore_info["nodes"])
                 self.destroy_layers(scene.view_layers, _restore_info["view_layers"])
+                self.restore_other_layers(_restore_info["disabled_layers"])
                 self.destroy_lights(_restore_info["lights"])
                 return {'FINISHED'}
 
@@ -538,14 +2814,18 @@ class Unity6Way:
             def draw(self, context):
                 scene = context.scene
                 unity6way = scene.unity6way
+                if _use_lightmaps_emissive(scene):
+                    self.layout.label(text="Emission is captured by the lightmaps render")
+                    return
                 self.layout.prop(unity6way.emissive, "filename")
                 render_operator = self.layout.operator(Unity6Way.RenderUndoOperator.bl_idname)
                 render_operator.prepare_operator = "unity_6way_emissive_prepare"
                 render_operator.restore_operator = "unity_6way_emissive_restore"
+                render_operator.stage = 'EMISSIVE'
 
                 row = self.layout.row()
                 dest_path = _get_emissive_path(unity6way, _get_current_frame(scene))
-                row.enabled = _file_exists(dest_path)
+                row.enabled = _output_exists(dest_path)
                 row.operator(Unity6Way.Emissive.ViewResultOperator.bl_idname)
 
         class PrepareOperator(bpy.types.Operator):
@@ -646,6 +2926,11 @@ class Unity6Way:
                 default = 1,
                 min = 0,
             )
+            direct: bpy.props.BoolProperty(
+                name = "Direct compositing",
+                description = "Compute compositing in-process from the lightmap files instead of re-rendering the scene",
+                default = True,
+            )
                 
         class Panel(bpy.types.Panel):
             bl_idname = "VIEW3D_PT_unity_6way_compositing"
@@ -673,19 +2958,24 @@ class Unity6Way:
                 row = self.layout.row()
                 row.enabled = unity6way.compositing.extra != 'NONE'
                 row.prop(unity6way.compositing, "extra_multiplier")
+                self.layout.prop(unity6way.compositing, "direct")
                 #self.layout.operator(Unity6Way.Compositing.ViewResultOperator.bl_idname)
-                render_operator = self.layout.operator(Unity6Way.RenderUndoOperator.bl_idname)
-                render_operator.prepare_operator = "unity_6way_compositing_prepare"
-                render_operator.restore_operator = "unity_6way_compositing_restore"
+                if _use_direct_compositing(scene):
+                    self.layout.operator(Unity6Way.Compositing.DirectOperator.bl_idname)
+                else:
+                    render_operator = self.layout.operator(Unity6Way.RenderUndoOperator.bl_idname)
+                    render_operator.prepare_operator = "unity_6way_compositing_prepare"
+                    render_operator.restore_operator = "unity_6way_compositing_restore"
+                    render_operator.stage = 'COMPOSITING'
                 
                 row = self.layout.row()
                 dest_paths = _get_compositing_paths(unity6way, _get_current_frame(scene))
                 col = row.column()
-                col.enabled = _file_exists(dest_paths[0])
+                col.enabled = _output_exists(dest_paths[0])
                 view_operator = col.operator(Unity6Way.Compositing.ViewResultOperator.bl_idname, text="View last +")
                 view_operator.positive = True
                 col = row.column()
-                col.enabled = _file_exists(dest_paths[1])
+                col.enabled = _output_exists(dest_paths[1])
                 view_operator = col.operator(Unity6Way.Compositing.ViewResultOperator.bl_idname, text="View last -")
                 view_operator.positive = False
 
@@ -696,25 +2986,7 @@ class Unity6Way:
             bl_options = {'REGISTER', 'UNDO'}
 
             def check_input_paths(self, scene):
-                missing_paths = []
-
-                unity6way = scene.unity6way
-                
-                if unity6way.compositing.extra == 'CUSTOM' and scene.frame_start == scene.frame_end:
-                    _check_input_path(missing_paths, bpy.path.abspath(unity6way.compositing.custom_path))
-                
-                for frame in range(scene.frame_start, scene.frame_end + 1):
-                    _check_input_path(missing_paths, _get_lightmaps_path(unity6way, frame))
-                    if unity6way.compositing.extra == 'EMISSIVE':
-                        _check_input_path(missing_paths, _get_emissive_path(unity6way, frame))
-                    
-                    if unity6way.compositing.extra == 'CUSTOM' and scene.frame_start < scene.frame_end:
-                        _check_input_path(missing_paths,  bpy.path.abspath(unity6way.compositing.custom_path)) #TODO add frame number
-
-                    if len(missing_paths) > 10:
-                        break
-                
-                return missing_paths
+                return _check_compositing_input_paths(scene, _get_render_frames(scene))
 
             def execute(self, context):
                 scene = context.scene
@@ -723,9 +2995,9 @@ class Unity6Way:
                 nodes = []
 
                 _restore_info["nodes"] = nodes   
-                missing_paths = self.check_input_paths(scene)
-                if missing_paths:
-                    _report_missing_inputs(self, missing_paths)
+                missing_paths, invalid_files = self.check_input_paths(scene)
+                if missing_paths or invalid_files:
+                    _report_missing_inputs(self, missing_paths, invalid_files)
                     return {'CANCELLED'}
 
                 tree = scene.node_tree                
@@ -737,6 +3009,9 @@ class Unity6Way:
                     case 'NONE':
                         extra_node = input_node
                         extra_channel = "Alpha"
+                    case 'EMISSIVE' if _use_lightmaps_emissive(scene):
+                        extra_node = input_node
+                        extra_channel = "Emissive"
                     case 'EMISSIVE':
                         emissive_path = _get_emissive_path(unity6way, scene.frame_start)
                         extra_node = _create_compositor_node_image_input(tree, _load_image(emissive_path), scene)
@@ -772,11 +3047,24 @@ class Unity6Way:
                     output_node.file_slots.new(slot_name)
                     output_node.file_slots[slot_name].use_node_format = True
 
-                for dir_name in _light_direction_names:
-                    tree.links.new(input_node.outputs[dir_name], combiner_node.inputs[dir_name])
-                tree.links.new(input_node.outputs["Alpha"], combiner_node.inputs["Alpha"])
-               
-                tree.links.new(extra_node.outputs[extra_channel], scale_node.inputs["Image"])
+                if all(layer_name in input_node.outputs for layer_name in _compact_lightmap_layers):
+                    for layer_name, names in _compact_lightmap_layers.items():
+                        separate_node = tree.nodes.new(type='CompositorNodeSepRGBA')
+                        nodes.append(separate_node)
+                        tree.links.new(input_node.outputs[layer_name], separate_node.inputs["Image"])
+                        for socket, name in zip(separate_node.outputs, names):
+                            if name != None:
+                                tree.links.new(socket, combiner_node.inputs[name])
+                            if name == "Alpha":
+                                alpha_socket = socket
+                else:
+                    for dir_name in _light_direction_names:
+                        tree.links.new(input_node.outputs[dir_name], combiner_node.inputs[dir_name])
+                    alpha_socket = input_node.outputs["Alpha"]
+                    tree.links.new(alpha_socket, combiner_node.inputs["Alpha"])
+
+                extra_socket = alpha_socket if extra_channel == "Alpha" else extra_node.outputs[extra_channel]
+                tree.links.new(extra_socket, scale_node.inputs["Image"])
                 tree.links.new(scale_node.outputs["Image"], combiner_node.inputs["Extra"])
                 
                 tree.links.new(combiner_node.outputs["Positive"], output_node.inputs[0])
@@ -796,6 +3084,83 @@ class Unity6Way:
 
                 return {'FINISHED'}     
 
+        class DirectOperator(bpy.types.Operator):
+            """Unity VFX Graph Six way compositing from lightmap files"""    #tooltip
+            bl_idname = "render.unity_6way_compositing_direct"
+            bl_label = "Composite"
+            bl_options = {'REGISTER', 'UNDO'}
+
+            def execute(self, context):
+                scene = context.scene
+                unity6way = scene.unity6way
+
+                frames = _get_render_frames(scene)
+
+                missing_paths, invalid_files = _check_compositing_input_paths(scene, frames)
+                if missing_paths or invalid_files:
+                    _report_missing_inputs(self, missing_paths, invalid_files)
+                    return {'CANCELLED'}
+
+                self.completed_frames = []
+                _begin_report_stage(scene, 'COMPOSITING')
+                try:
+                    return self.composite(context, frames)
+                finally:
+                    output_paths = _get_frames_output_paths(unity6way, 'COMPOSITING', self.completed_frames)
+                    _end_report_stage(scene, output_paths)
+                    _rescan_output_states(output_paths)
+
+            def composite(self, context, frames):
+                scene = context.scene
+                unity6way = scene.unity6way
+
+                settings = _get_compositing_settings(scene)
+                custom_extra = None
+                if settings["extra"] == 'CUSTOM':
+                    header = _read_exr_header(_get_lightmaps_path(unity6way, frames[0]))
+                    custom_extra = _load_custom_extra(unity6way, *_get_exr_size(header))
+
+                duplicates = {}
+                if unity6way.reuse_duplicate_frames and not _is_worker:
+                    with _report_time("duplicate_seconds"):
+                        frames, duplicates, _content_hashes = _split_duplicate_frames(context, 'COMPOSITING', frames)
+
+                frame_hashes = {}
+                if unity6way.use_cache:
+                    with _report_time("hash_seconds"):
+                        frame_hashes = _get_compositing_hashes(scene, frames)
+                    frames = _filter_cached_frames(unity6way, 'COMPOSITING', frames, frame_hashes)
+
+                wm = context.window_manager
+                wm.progress_begin(0, len(frames))
+
+                completed_frames = self.completed_frames
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    futures = {}
+                    for frame in frames:
+                        future = executor.submit(_composite_frame_files, settings, frame,
+                            _get_lightmaps_path(unity6way, frame), _get_emissive_path(unity6way, frame),
+                            _get_compositing_paths(unity6way, frame), custom_extra)
+                        futures[future] = frame
+                    try:
+                        for future in concurrent.futures.as_completed(futures):
+                            future.result()
+                            completed_frames.append(futures[future])
+                            wm.progress_update(len(completed_frames))
+                    except (_ExrError, OSError) as error:
+                        for future in futures:
+                            future.cancel()
+                        wm.progress_end()
+                        _update_cache_manifest(unity6way, 'COMPOSITING', completed_frames, frame_hashes)
+                        self.report({'ERROR'}, str(error))
+                        return {'CANCELLED'}
+
+                wm.progress_end()
+                _update_cache_manifest(unity6way, 'COMPOSITING', completed_frames, frame_hashes)
+                _copy_duplicate_outputs(unity6way, 'COMPOSITING', duplicates)
+                completed_frames.extend(duplicates)
+                return {'FINISHED'}
+
         class RestoreOperator(bpy.types.Operator):
             """Unity VFX Graph Six way render lighting"""    #tooltip
             bl_idname = "render.unity_6way_compositing_restore"
@@ -857,7 +3222,7 @@ class Unity6Way:
                 items={
                     ('PNG', '.png', "PNG"),
                     ('TARGA', '.tga', "Targa"),
-                    #('OPEN_EXR', '.exr', "Open EXR"),
+                    ('OPEN_EXR', '.exr', "Open EXR"),
                 },
                 default='PNG'
             )
@@ -882,6 +3247,83 @@ class Unity6Way:
                 default = 1,
                 min = 1,
             )
+            color_depth: bpy.props.EnumProperty(
+                name = "Color depth",
+                description = "Bits per channel of PNG files, Targa files are always 8-bit and Open EXR files half float",
+                items = {
+                    ('8', "8", "8 bits per channel", 0),
+                    ('16', "16", "16 bits per channel", 1),
+                },
+                default = '8',
+            )
+            compression: bpy.props.IntProperty(
+                name = "Compression",
+                description = "PNG zlib compression level, lower levels write faster and larger files",
+                default = 6,
+                min = 0,
+                max = 9,
+            )
+            use_rle: bpy.props.BoolProperty(
+                name = "RLE",
+                description = "Run-length encode Targa files",
+                default = True,
+            )
+            use_srgb: bpy.props.BoolProperty(
+                name = "sRGB",
+                description = "Encode the color channels of PNG and Targa files with the sRGB transfer function instead of linear values",
+                default = False,
+            )
+            dither: bpy.props.BoolProperty(
+                name = "Dither",
+                description = "Add one step of noise before quantization to hide banding",
+                default = False,
+            )
+            filter: bpy.props.EnumProperty(
+                name = "Filter",
+                description = "Filter used to scale the frames to the tile size",
+                items = {
+                    ('AUTO', "Auto", "Box filter for integer ratios, Mitchell otherwise", 0),
+                    ('BOX', "Box", "Average of the covered pixels", 1),
+                    ('MITCHELL', "Mitchell", "Mitchell-Netravali cubic filter", 2),
+                    ('LANCZOS', "Lanczos", "Sharp three-lobe Lanczos filter", 3),
+                    ('BLENDER', "Blender", "Blender image scaling, as in previous versions", 4),
+                },
+                default = 'AUTO',
+            )
+            lod_count: bpy.props.IntProperty(
+                name = "Levels",
+                description = "Number of flipbook resolutions written in one export, each level is half the size of the previous one",
+                default = 1,
+                min = 1,
+                max = 8,
+            )
+            lod_filename: bpy.props.StringProperty(
+                name = "Level name",
+                description = "Filename of the smaller levels, {name} is the flipbook filename, {size} the width and {level} the level number",
+                default = "{name}_{size}",
+            )
+            padding: bpy.props.IntProperty(
+                name = "Padding",
+                description = "Pixels around each frame filled with its edge pixels, so mipmaps do not blend neighbouring frames",
+                default = 0,
+                min = 0,
+                soft_max = 16,
+            )
+            write_mipmaps: bpy.props.BoolProperty(
+                name = "DDS with mipmaps",
+                description = "Also write each flipbook as an uncompressed DDS file with mipmaps filtered tile by tile",
+                default = False,
+            )
+            share_duplicates: bpy.props.BoolProperty(
+                name = "Share duplicate tiles",
+                description = "Give repeated and identical frames a single tile and write the tile of each flipbook frame to a JSON file next to the flipbook",
+                default = False,
+            )
+            streaming: bpy.props.BoolProperty(
+                name = "Streaming export",
+                description = "Write the flipbook one tile row at a time to keep memory usage bounded (PNG and Targa only)",
+                default = False,
+            )
                         
         class Panel(bpy.types.Panel):
             bl_idname = "VIEW3D_PT_unity_6way_flipbook"
@@ -908,20 +3350,43 @@ class Unity6Way:
                 row = col.row()
                 row.prop(unity6way.flipbook, "filename2")
                 self.layout.prop(unity6way.flipbook, "dest_format", expand=True)
+                match unity6way.flipbook.dest_format:
+                    case 'PNG':
+                        row = self.layout.row()
+                        row.prop(unity6way.flipbook, "color_depth", expand=True)
+                        row.prop(unity6way.flipbook, "compression")
+                    case 'TARGA':
+                        self.layout.prop(unity6way.flipbook, "use_rle")
+                if unity6way.flipbook.dest_format != 'OPEN_EXR' or unity6way.flipbook.write_mipmaps:
+                    row = self.layout.row()
+                    row.prop(unity6way.flipbook, "use_srgb")
+                    row.prop(unity6way.flipbook, "dither")
                 self.layout.prop(unity6way.flipbook, "image_size")
                 self.layout.prop(unity6way.flipbook, "tiling")
                 row = self.layout.row()
+                row.enabled = not (unity6way.trim_flipbook and _is_trimmed(context.scene))
                 row.prop(unity6way.flipbook, "frame_step")
+                self.layout.prop(unity6way.flipbook, "filter")
+                row = self.layout.row()
+                row.prop(unity6way.flipbook, "padding")
+                row.prop(unity6way.flipbook, "write_mipmaps")
+                self.layout.prop(unity6way.flipbook, "share_duplicates")
+                row = self.layout.row()
+                row.prop(unity6way.flipbook, "lod_count")
+                sub = row.row()
+                sub.enabled = unity6way.flipbook.lod_count > 1
+                sub.prop(unity6way.flipbook, "lod_filename")
+                self.layout.prop(unity6way.flipbook, "streaming")
                 self.layout.operator(Unity6Way.Flipbook.ExportOperator.bl_idname)
 
                 row = self.layout.row()
                 output_paths = _get_export_paths(unity6way)
                 col = row.column()
-                col.enabled = _file_exists(output_paths[0])
+                col.enabled = _output_exists(output_paths[0])
                 view_operator = col.operator(Unity6Way.Flipbook.ViewResultOperator.bl_idname, text="View last +")
                 view_operator.positive = True
                 col = row.column()
-                col.enabled = _file_exists(output_paths[1])
+                col.enabled = _output_exists(output_paths[1])
                 view_operator = col.operator(Unity6Way.Flipbook.ViewResultOperator.bl_idname, text="View last -")
                 view_operator.positive = False
                 
@@ -932,101 +3397,284 @@ class Unity6Way:
             bl_label = "Export Flipbook"
             bl_options = {'REGISTER', 'UNDO'}
 
-            def check_input_paths(self, unity6way, frame_start, frame_end):
-                missing_paths = []
-                
-                for frame in range(frame_start, frame_end + 1):
-                    input_paths = _get_compositing_paths(unity6way, frame)
-                    _check_input_path(missing_paths, input_paths[0])
-                    _check_input_path(missing_paths, input_paths[1])
+            def get_tiles(self, scene):
+                unity6way = scene.unity6way
+                tiling = unity6way.flipbook.tiling
+                frames = _get_flipbook_frames(scene)
+                #tile of each flipbook frame
+                self.tile_indices = list(range(len(frames)))
+                if unity6way.flipbook.share_duplicates:
+                    #repeated frames and frames with identical files share the tile of the first one
+                    duplicates = _get_duplicate_frames(_get_file_hashes(sorted(set(frames)), lambda frame: _get_compositing_paths(unity6way, frame)))
+                    tile_frames = []
+                    self.tile_indices = []
+                    for frame in frames:
+                        frame = duplicates.get(frame, frame)
+                        if frame not in tile_frames:
+                            tile_frames.append(frame)
+                        self.tile_indices.append(tile_frames.index(frame))
+                    frames = tile_frames
+                return _get_flipbook_tiles(frames, tiling)
+
+            def load_tile_pixels(self, input_path, tile_width, tile_height):
+                with _report_time("load_seconds"):
+                    src_image = _load_image(input_path)
+                with _report_time("scale_seconds"):
+                    src_image.scale(tile_width, tile_height)
+                with _report_time("copy_seconds"):
+                    pixels = _get_image_pixels(src_image)
+                bpy.data.images.remove(src_image)
+                return pixels
+
+            def load_tile_pair(self, input_paths, tile_width, tile_height, filter, premultiplied):
+                if filter == 'BLENDER':
+                    return tuple(self.load_tile_pixels(path, tile_width, tile_height) for path in input_paths)
+                #Blender decodes the files the built-in reader cannot, the filter still applies
+                pixels = []
+                for path in input_paths:
+                    with _report_time("load_seconds"):
+                        src_image = _load_image(path)
+                        pixels.append(_get_image_pixels(src_image))
+                        bpy.data.images.remove(src_image)
+                with _report_time("scale_seconds"):
+                    return _resample_tile_pair(pixels[0], pixels[1], tile_width, tile_height, filter, premultiplied)
+
+            def load_tiles(self, unity6way, tiles, tile_width, tile_height):
+                # yields each tile with its positive and negative pixels in order, frames ahead are decoded in a thread pool
+                filter = unity6way.flipbook.filter
+                premultiplied = unity6way.compositing.premultiplied
+                #frames are scaled to the tile without its gutter
+                padding = _get_tile_padding(unity6way.flipbook)
+                tile_width -= 2 * padding
+                tile_height -= 2 * padding
+
+                def load(frame):
+                    if filter == 'BLENDER':
+                        return None
+                    try:
+                        return _load_tile_pair(_get_compositing_paths(unity6way, frame), tile_width, tile_height, filter, premultiplied, frame)
+                    except _ExrError:
+                        return None
+
+                #each frame ahead holds both decoded files, the streaming export keeps a single one ahead
+                workers = 1 if unity6way.flipbook.streaming else os.cpu_count() or 1
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    next_tiles = iter(tiles)
+                    futures = collections.deque((tile, executor.submit(load, tile[2]))
+                        for tile in itertools.islice(next_tiles, 2 * workers - 1))
+                    while futures:
+                        tile, future = futures.popleft()
+                        for next_tile in itertools.islice(next_tiles, 1):
+                            futures.append((next_tile, executor.submit(load, next_tile[2])))
+                        pair = future.result()
+                        if pair == None:
+                            pair = self.load_tile_pair(_get_compositing_paths(unity6way, tile[2]), tile_width, tile_height, filter, premultiplied)
+                        yield tile, _pad_tile_pair(pair, padding)
+
+            def get_lods(self, unity6way):
+                # (image size, tile size, output paths) of each level below the full resolution
+                flipbook = unity6way.flipbook
+                lods = []
+                for level, (size, tile_size) in enumerate(_get_flipbook_level_sizes(flipbook.image_size, flipbook.tiling, flipbook.lod_count), 1):
+                    paths = []
+                    for path in _get_export_paths(unity6way):
+                        directory, filename = os.path.split(path)
+                        name, extension = os.path.splitext(filename)
+                        paths.append(os.path.join(directory, flipbook.lod_filename.format(name=name, size=size[0], level=level) + extension))
+                    lods.append((size, tile_size, paths))
+                return lods
+
+            def get_mipmap_paths(self, unity6way, output_paths):
+                return [os.path.splitext(path)[0] + ".dds" for path in output_paths] if unity6way.flipbook.write_mipmaps else []
+
+            def get_lod_filter(self, unity6way):
+                #Blender scaling only applies to the frames
+                return 'AUTO' if unity6way.flipbook.filter == 'BLENDER' else unity6way.flipbook.filter
+
+            def write_band(self, write_rows, rows, settings, seed):
+                with _report_time("write_seconds"):
+                    write_rows(_quantize(rows, settings, seed))
+
+            def export_streaming(self, context, unity6way, tiles, output_paths, lods):
+                tiling = unity6way.flipbook.tiling
+                flipbook_size = unity6way.flipbook.image_size
+                tile_width = flipbook_size[0] // tiling[0]
+                tile_height = flipbook_size[1] // tiling[1]
+                lod_filter = self.get_lod_filter(unity6way)
+                premultiplied = unity6way.compositing.premultiplied
+                mipmap_paths = self.get_mipmap_paths(unity6way, output_paths)
+                level_sizes = _get_flipbook_level_sizes(flipbook_size, tiling) if mipmap_paths else [(size, tile_size) for size, tile_size, _paths in lods]
+                level_sizes = [(tuple(flipbook_size), (tile_width, tile_height))] + level_sizes
+
+                settings = _get_flipbook_write_settings(unity6way)
+                mipmap_settings = dict(settings, bits = 8)
+                writers = [_open_stream_writer(path, settings, flipbook_size[0], flipbook_size[1]) for path in output_paths]
+                lod_writers = [[_open_stream_writer(path, settings, size[0], size[1]) for path in paths] for size, _tile_size, paths in lods]
+                mipmap_writers = [_DdsStreamWriter(path, flipbook_size[0], flipbook_size[1], len(level_sizes)) for path in mipmap_paths]
+                all_writers = writers + [writer for level_writers in lod_writers for writer in level_writers] + mipmap_writers
+
+                # (write function, settings) of the positive and negative files of each level
+                level_outputs = [[[(writer.write_rows, settings)] for writer in level_writers] for level_writers in [writers] + lod_writers]
+                level_outputs += [[[], []] for _level in range(len(level_sizes) - len(level_outputs))]
+                for level, outputs in enumerate(level_outputs):
+                    for i, writer in enumerate(mipmap_writers):
+                        outputs[i].append((functools.partial(writer.write_rows, level = level), mipmap_settings))
+
+                # rows above the last full tile row stay empty
+                for (size, (_level_tile_width, level_tile_height)), outputs in zip(level_sizes, level_outputs):
+                    empty_rows = np.zeros((size[1] - tiling[1] * level_tile_height, size[0], 4), dtype=np.float32)
+                    if len(empty_rows):
+                        for write_rows, write_settings in outputs[0] + outputs[1]:
+                            write_rows(_quantize(empty_rows, write_settings))
 
-                    if len(missing_paths) > 8:
-                        break
-                
-                return missing_paths
+                wm = context.window_manager
+                wm.progress_begin(0, len(tiles))
+
+                # one band holds a single tile row of both flipbooks, written top row first
+                band = np.zeros((2, tile_height, flipbook_size[0], 4), dtype=np.float32)
+                band_tiles = sorted(tiles, key=lambda tile: -tile[1])
+                loaded_tiles = self.load_tiles(unity6way, band_tiles, tile_width, tile_height)
+                progress = 0
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as band_writer:
+                    pending_writes = []
+                    for tile_y in reversed(range(tiling[1])):
+                        band[...] = 0
+                        for _tile in range(sum(1 for _x, band_y, _frame in tiles if band_y == tile_y)):
+                            (tile_x, _y, frame), pair = next(loaded_tiles)
+                            for i in range(2):
+                                tile = _get_tile_view(band[i], tile_x, 0, tile_width, tile_height)
+                                with _report_time("copy_seconds"):
+                                    tile[...] = pair[i]
+                            progress += 1
+                            wm.progress_update(progress)
+
+                        #each level is filtered from the band of the previous one into rows of its own,
+                        #so the band is filled again while they are written
+                        band_writes = []
+                        level_band = band[:, :, :tiling[0] * tile_width]
+                        for level, ((size, (level_tile_width, level_tile_height)), outputs) in enumerate(zip(level_sizes, level_outputs)):
+                            if level > 0:
+                                with _report_time("scale_seconds"):
+                                    level_band = _downsample_flipbook(level_band, (tiling[0], 1), level_tile_width, level_tile_height, lod_filter, premultiplied)
+                            level_rows = np.zeros((2, level_tile_height, size[0], 4), dtype=np.float32)
+                            level_rows[:, :, :level_band.shape[2]] = level_band
+                            row_offset = (tiling[1] - 1 - tile_y) * level_tile_height
+                            band_writes += [(write_rows, level_rows[i][::-1], write_settings, row_offset)
+                                for i in range(2) for write_rows, write_settings in outputs[i]]
+
+                        #every file takes its bands in order
+                        for future in pending_writes:
+                            future.result()
+                        pending_writes = [band_writer.submit(self.write_band, *band_write) for band_write in band_writes]
+
+                    for future in pending_writes:
+                        future.result()
+                for writer in all_writers:
+                    writer.close()
+
+                wm.progress_end()
 
             def execute(self, context):
                 scene = context.scene
                 unity6way = scene.unity6way
 
-                frame_start, frame_end = _get_frames_range(scene)
+                tiles = self.get_tiles(scene)
 
-                missing_paths = self.check_input_paths(unity6way, frame_start, frame_end)
-                if missing_paths:
-                    _report_missing_inputs(self, missing_paths)
+                #frames handed over in memory have no files to check
+                frames = sorted(set(frame for _x, _y, frame in tiles))
+                if _frame_store != None:
+                    frames = [frame for frame in frames if not _frame_store.contains('COMPOSITING', frame)]
+                missing_paths, invalid_files = _check_flipbook_input_paths(unity6way, frames)
+                if missing_paths or invalid_files:
+                    _report_missing_inputs(self, missing_paths, invalid_files)
                     return {'CANCELLED'}
 
+                output_paths = _get_export_paths(unity6way)
+                try:
+                    lods = self.get_lods(unity6way)
+                except (KeyError, IndexError, ValueError) as error:
+                    self.report({'ERROR'}, "Invalid level name {0}: {1}".format(unity6way.flipbook.lod_filename, error))
+                    return {'CANCELLED'}
+                written_paths = list(output_paths) + [path for _size, _tile_size, paths in lods for path in paths] + self.get_mipmap_paths(unity6way, output_paths)
+                #a level name without {name} or {level} would overwrite another output
+                if len(set(os.path.normcase(os.path.abspath(path)) for path in written_paths)) != len(written_paths):
+                    self.report({'ERROR'}, "Level name {0} gives the same file for several outputs".format(unity6way.flipbook.lod_filename))
+                    return {'CANCELLED'}
+
+                _begin_report_stage(scene, 'FLIPBOOK')
+                try:
+                    result = self.export(context, tiles, output_paths, lods)
+                    if unity6way.flipbook.share_duplicates and result == {'FINISHED'}:
+                        self.write_tile_index(unity6way, tiles)
+                    return result
+                finally:
+                    _end_report_stage(scene, written_paths)
+                    _rescan_output_states(written_paths)
+
+            def write_tile_index(self, unity6way, tiles):
+                # tiles are numbered left to right from the top row, as Unity reads flipbooks
+                tile_index = {
+                    "tiling": list(unity6way.flipbook.tiling),
+                    "padding": _get_tile_padding(unity6way.flipbook),
+                    "tile_count": len(tiles),
+                    "tile_frames": [frame for _x, _y, frame in tiles],
+                    "frame_tiles": self.tile_indices,
+                }
+                with open(_get_tile_index_path(unity6way), 'w') as file:
+                    json.dump(tile_index, file, indent=1)
+
+            def export(self, context, tiles, output_paths, lods):
+                global _overlapped_atlas
+                scene = context.scene
+                unity6way = scene.unity6way
+                #tiles placed while the lightmaps rendered, used once
+                overlapped_atlas, _overlapped_atlas = _overlapped_atlas, None
+
+                if unity6way.flipbook.streaming and unity6way.flipbook.dest_format in ('PNG', 'TARGA'):
+                    self.export_streaming(context, unity6way, tiles, output_paths, lods)
+                    _show_image(output_paths[0], 'CHANNEL_PACKED')
+                    return {'FINISHED'}
+
                 tiling = unity6way.flipbook.tiling
 
                 flipbook_size = unity6way.flipbook.image_size
-                flipbook_row = flipbook_size[0] * 4
-                flipbook_total = flipbook_row * flipbook_size[1]
 
                 tile_width = flipbook_size[0] // tiling[0]
                 tile_height = flipbook_size[1] // tiling[1]
-                tile_row = tile_width * 4
-
-                dst_pixels = [0] * (flipbook_total * 2)
 
-                wm = context.window_manager
-                wm.progress_begin(frame_start, frame_end + 1)
-
-                for frame in range(frame_start, frame_end + 1):
-                    frame_index = frame - frame_start
-                    tile_x = frame_index % tiling[0]
-                    tile_y = frame_index // tiling[0]
-                    if tile_y < tiling[1]:
-                        tile_y = tiling[1] - tile_y - 1
-                        img_index = min(frame_end, max(1, (frame * unity6way.flipbook.frame_step) - 1))
-                        input_paths = _get_compositing_paths(unity6way, img_index)
-                        for i in range(2):
-                            src_image = _load_image(input_paths[i])
-                            src_image.scale(tile_width, tile_height)
-                            src_pixels = list(src_image.pixels)
-
-                            src_offset = 0
-                            dst_offset = flipbook_total * i + tile_x * tile_row + tile_y * tile_height * flipbook_row
-                            for y in range(tile_height):
-                                dst_pixels[dst_offset:dst_offset+tile_row] = src_pixels[src_offset:src_offset+tile_row]
-                                src_offset += tile_row
-                                dst_offset += flipbook_row
-                            
-                            bpy.data.images.remove(src_image)                            
-                    wm.progress_update(frame)
+                # positive and negative atlases, rows stored bottom-up like bpy image pixels
+                if overlapped_atlas != None and overlapped_atlas[0] == tiles and overlapped_atlas[1].shape[1:3] == (flipbook_size[1], flipbook_size[0]):
+                    dst_pixels = overlapped_atlas[1]
+                else:
+                    dst_pixels = np.zeros((2, flipbook_size[1], flipbook_size[0], 4), dtype=np.float32)
 
-                wm.progress_end()
+                    wm = context.window_manager
+                    wm.progress_begin(0, len(tiles))
 
-                output_paths = _get_export_paths(unity6way)
-                for i in range(2):
-                    
-                    output_filename = bpy.path.basename(output_paths[i])
-                    output_image = bpy.data.images.get(output_filename)
-                    if output_image != None:
-                        bpy.data.images.remove(output_image)
-                    output_image = bpy.data.images.new(output_filename, width=flipbook_size[0], height=flipbook_size[1], alpha=True)
-                    output_image.alpha_mode = 'CHANNEL_PACKED'
-                    output_image.filepath_raw = output_paths[i]
-                    output_image.file_format = unity6way.flipbook.dest_format
-                    output_image.pixels = dst_pixels[flipbook_total*i:flipbook_total*(i+1)]
-
-                    #workaround to save files to different formats (save not working properly)
-                    #read scene settings
-                    settings = scene.render.image_settings
-                    current_format = settings.file_format
-                    current_mode = settings.color_mode
-                    current_depth = settings.color_depth
-                    
-                    #set image scene settings
-                    settings.file_format = unity6way.flipbook.dest_format
-                    settings.color_mode = 'RGBA'
-                    settings.color_depth = '16' if unity6way.flipbook.dest_format == 'OPEN_EXR' else '8'                    
-
-                    output_image.save_render(filepath=output_paths[i]) 
-
-                    #restore scene settings
-                    settings.file_format = current_format
-                    settings.color_mode = current_mode
-                    settings.color_depth = current_depth
+                    for tile_index, ((tile_x, tile_y, frame), pair) in enumerate(self.load_tiles(unity6way, tiles, tile_width, tile_height)):
+                        for i in range(2):
+                            tile = _get_tile_view(dst_pixels[i], tile_x, tile_y, tile_width, tile_height)
+                            with _report_time("copy_seconds"):
+                                tile[...] = pair[i]
+                        wm.progress_update(tile_index + 1)
+
+                    wm.progress_end()
+
+                #smaller levels are filtered from the previous one, the level files and mipmaps share them
+                mipmap_paths = self.get_mipmap_paths(unity6way, output_paths)
+                level_sizes = _get_flipbook_level_sizes(flipbook_size, tiling) if mipmap_paths else [(size, tile_size) for size, tile_size, _paths in lods]
+                levels = [dst_pixels] + list(_get_flipbook_levels(dst_pixels, tiling, (tile_width, tile_height), level_sizes,
+                    self.get_lod_filter(unity6way), unity6way.compositing.premultiplied))
+                level_paths = [output_paths] + [paths for _size, _tile_size, paths in lods]
+
+                #positive and negative files of every level are encoded concurrently
+                settings = _get_flipbook_write_settings(unity6way)
+                with _report_time("write_seconds"):
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                        futures = [executor.submit(_write_image, paths[i], levels[level][i], settings) for level, paths in enumerate(level_paths) for i in range(2)]
+                        futures += [executor.submit(_write_dds, path, [pixels[i] for pixels in levels], dict(settings, bits = 8)) for i, path in enumerate(mipmap_paths)]
+                        for future in futures:
+                            future.result()
 
                 _show_image(output_paths[0], 'CHANNEL_PACKED')
                                 
@@ -1048,223 +3696,162 @@ class Unity6Way:
                 return {'FINISHED'}
 
 
+    class TrimOperator(bpy.types.Operator):
+        """Find the first and last frames with visible content in a low resolution render"""    #tooltip
+        bl_idname = "render.unity_6way_trim"
+        bl_label = "Find visible frames"
+        bl_options = {'REGISTER'}
+
+        def execute(self, context):
+            scene = context.scene
+            unity6way = scene.unity6way
+            frame_start, frame_end = _get_full_frames_range(scene)
+            path = _get_input_path(unity6way.temp_path, _trim_filename, "exr")
+
+            _begin_report_stage(scene, 'TRIM')
+            frame_current = scene.frame_current
+            restore = self.prepare(scene, path)
+            try:
+                #only the empty frames at both ends and the first visible ones are rendered
+                frames = range(frame_start, frame_end + 1)
+                first = next((frame for frame in frames if self.is_visible(scene, frame, path)), None)
+                last = first
+                if first != None:
+                    last = next(frame for frame in reversed(frames) if frame == first or self.is_visible(scene, frame, path))
+            finally:
+                self.restore(restore)
+                scene.frame_set(frame_current)
+                if os.path.exists(path):
+                    os.remove(path)
+                _end_report_stage(scene)
+
+            if first == None:
+                unity6way.trimmed_range = (0, 0, 0, 0)
+                self.report({'WARNING'}, "No visible frames, the full frame range is kept")
+                return {'FINISHED'}
+
+            unity6way.trimmed_range = (frame_start, frame_end, first, last)
+            self.report({'INFO'}, "Visible frames {0}-{1}".format(first, last))
+            return {'FINISHED'}
+
+        def prepare(self, scene, path):
+            render = scene.render
+            #(struct, attribute, value) set back after the pre-pass, in reverse order
+            restore = []
+            def override(struct, attribute, value):
+                restore.append((struct, attribute, getattr(struct, attribute)))
+                setattr(struct, attribute, value)
+
+            width = render.resolution_x * render.resolution_percentage / 100
+            height = render.resolution_y * render.resolution_percentage / 100
+            scale = min(1.0, _trim_resolution / max(width, height))
+            override(render, "resolution_x", max(1, round(width * scale)))
+            override(render, "resolution_y", max(1, round(height * scale)))
+            override(render, "resolution_percentage", 100)
+            override(render, "film_transparent", True)
+            override(render, "use_motion_blur", False)
+            override(render, "use_compositing", False)
+            override(render, "use_sequencer", False)
+            override(render, "filepath", path)
+            override(render.image_settings, "file_format", 'OPEN_EXR')
+            override(render.image_settings, "color_mode", 'RGBA')
+            override(render.image_settings, "color_depth", '16')
+            override(render.image_settings, "exr_codec", 'NONE')
+            if render.engine == 'CYCLES':
+                override(scene.cycles, "samples", _trim_samples)
+                override(scene.cycles, "use_adaptive_sampling", False)
+                override(scene.cycles, "use_denoising", False)
+            elif render.engine.startswith('BLENDER_EEVEE'):
+                override(scene.eevee, "taa_render_samples", _trim_samples)
+            return restore
+
+        def restore(self, restore):
+            for struct, attribute, value in reversed(restore):
+                setattr(struct, attribute, value)
+
+        def is_visible(self, scene, frame, path):
+            scene.frame_set(frame)
+            bpy.ops.render.render(write_still=True)
+            _width, _height, channels = _read_exr(path)
+            pixels = _get_exr_rgba(channels)
+            #emission without density leaves the alpha empty, visible color counts as well
+            return bool(np.any(pixels > _trim_threshold))
+
     class RenderUndoOperator(bpy.types.Operator):
         """Unity VFX Graph Six way render operator"""    #tooltip
         bl_idname = "render.unity_6way_render"
         bl_label = "Render"
-        bl_options = {'REGISTER', 'UNDO'}
+        #the render continues in handlers after execute, an undo step would hold the prepared scene
+        bl_options = {'REGISTER'}
 
         prepare_operator: bpy.props.StringProperty()
         restore_operator: bpy.props.StringProperty()
+        stage: bpy.props.StringProperty()
 
-        
-        _restore_start_frame = 0
-        _restore_end_frame = 0
-        _restore_scene_info = {}
-        _restore_world_info = {}
-        _restore_nodes = []
-        _restore_lights = []
-        _restore_lock_interface = False        
-
-        _timer = None
-
-        def _prepare(self, context):
-            scene = context.scene
-            
-            scene.unity6way.is_cancelled = False
-            scene.unity6way.is_locked = True
-            self._restore_lock_interface = scene.render.use_lock_interface
-            scene.render.use_lock_interface = True
-
-            self._prepare_scene(scene)
-            self._prepare_world(scene.world)
-            self._prepare_frames_range(scene)
-            self._disable_existing_nodes(scene.node_tree)
-            self._disable_existing_lights()
-
-            _restore_info = {}
-            getattr(bpy.ops.render, self.prepare_operator)()
-
-            bpy.app.handlers.render_init.append(_on_render_init)
-            bpy.app.handlers.render_cancel.append(_on_render_cancel)
-            bpy.app.handlers.render_complete.append(_on_render_complete)
-            
-            # should be here, but it needs to be started later or it gets removed
-            #self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
-
-        def _restore(self, context):
-            scene = context.scene
-            
-            context.window_manager.event_timer_remove(self._timer)
-
-            bpy.app.handlers.render_complete.remove(_on_render_complete)
-            bpy.app.handlers.render_cancel.remove(_on_render_cancel)
-            bpy.app.handlers.render_init.remove(_on_render_init)
-
-            getattr(bpy.ops.render, self.restore_operator)()
-            _restore_info = {}
-
-            self._restore_existing_lights()
-            self._restore_existing_nodes(scene.node_tree)
-            self._restore_frames_range(scene)
-            self._restore_world(scene.world)
-            self._restore_scene(scene)
-
-            scene.render.use_lock_interface = self._restore_lock_interface
-            scene.unity6way.is_locked = False
-
-        def _prepare_frames_range(self, scene):
-            self._restore_frame_start = scene.frame_start
-            self._restore_frame_end = scene.frame_end
-            frame_start, frame_end = _get_frames_range(scene)
-            scene.frame_start = frame_start
-            scene.frame_end = frame_end
-
-        def _restore_frames_range(self, scene):
-            scene.frame_start = self._restore_frame_start
-            scene.frame_end = self._restore_frame_end
-
-        def _prepare_scene(self, scene):
-            self._restore_scene_info = {}
-            self._restore_scene_info["use_nodes"] = scene.use_nodes
-            scene.use_nodes = True
-            self._restore_scene_info["film_transparent"] = scene.render.film_transparent
-            scene.render.film_transparent = True
-            self._restore_scene_info["exposure"] = scene.view_settings.exposure
-            scene.view_settings.exposure = 0
-            self._restore_scene_info["gamma"] = scene.view_settings.gamma
-            scene.view_settings.gamma = 2.2
-            self._restore_scene_info["view_transform"] = scene.view_settings.view_transform
-            scene.view_settings.view_transform = 'Raw'
-
-        def _restore_scene(self, scene):
-            scene.use_nodes = self._restore_scene_info["use_nodes"]
-            scene.render.film_transparent = self._restore_scene_info["film_transparent"]
-            scene.view_settings.exposure = self._restore_scene_info["exposure"]
-            scene.view_settings.gamma = self._restore_scene_info["gamma"]
-            scene.view_settings.view_transform = self._restore_scene_info["view_transform"]
-            self._restore_scene_info = {}
-
-        def _prepare_world(self, world):
-            self._restore_world_info["use_nodes"] = world.use_nodes
-            world.use_nodes = False
-            self._restore_world_info["bg_color"] = world.color
-            world.color = [0, 0, 0]
-
-        def _restore_world(self, world):
-            world.use_nodes = self._restore_world_info["use_nodes"]
-            world.color = self._restore_world_info["bg_color"]
-
-        def _disable_existing_nodes(self, tree):
-            self._restore_nodes = []
-            for node in tree.nodes:
-                if not node.mute:
-                    self._restore_nodes.append(node)
-                    node.mute = True
-
-        def _restore_existing_nodes(self, tree):
-            for node in self._restore_nodes:
-                node.mute = False
-
-        def _disable_existing_lights(self):
-            self._restore_lights = []
-            for object in bpy.data.objects:
-                if object.type == 'LIGHT':
-                    light_object = object
-                    if not light_object.hide_render:
-                        self._restore_lights.append(light_object)
-                        light_object.hide_render = True
-
-        def _restore_existing_lights(self):
-            for light_object in self._restore_lights:
-                light_object.hide_render = False
-
-        def modal(self, context, event):
-            if context.scene.unity6way.is_rendering:
-                return {'RUNNING_MODAL'}
-            self._restore(context)
-            return {'FINISHED'}
-
-        def cancel(self, context):
-            context.scene.unity6way.is_cancelled = True
-            self._restore(context)
- 
         def execute(self, context):
-            scene = context.scene
-            unity6way = scene.unity6way
-            
-            self._prepare(context)
-            _frame_start, _frame_end = _get_frames_range(scene)
-
-            bpy.ops.render.render('INVOKE_DEFAULT', animation=True)
-
-            self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
-            context.window_manager.modal_handler_add(self)
-            return {'RUNNING_MODAL'}
+            render_stage = _RenderStage(self.prepare_operator, self.restore_operator, self.stage)
+            result = render_stage.start(context)
+            if render_stage.is_up_to_date:
+                self.report({'INFO'}, "All frames are up to date")
+            #the render handlers finish the stage
+            return {'FINISHED'} if result == {'RUNNING_MODAL'} else result
 
     class RenderAllOperator(bpy.types.Operator):
         """Unity VFX Graph Six way render lighting"""    #tooltip
         bl_idname = "render.unity_6way_render_all"
         bl_label = "Render all"
-        bl_options = {'REGISTER', 'UNDO'}
-
-        _stages = ['LIGHTMAPS', 'EMISSIVE', 'COMPOSITING', 'FLIPBOOK']
-        _stage_index = 0
-
-        _timer = None
-
-        def _run_next_stage(self, context):
-            stage = self._stages[self._stage_index] if self._stage_index < len(self._stages) else ''
-            match stage:
-                case 'LIGHTMAPS':
-                    bpy.ops.render.unity_6way_render(prepare_operator = "unity_6way_lightmap_prepare", restore_operator = "unity_6way_lightmap_restore")
-                    return {'RUNNING_MODAL'}
-                case 'EMISSIVE':
-                    bpy.ops.render.unity_6way_render(prepare_operator = "unity_6way_emissive_prepare", restore_operator = "unity_6way_emissive_restore")
-                    return {'RUNNING_MODAL'}
-                case 'COMPOSITING':
-                    bpy.ops.render.unity_6way_render(prepare_operator = "unity_6way_compositing_prepare", restore_operator = "unity_6way_compositing_restore")
-                    return {'RUNNING_MODAL'}
-                case 'FLIPBOOK':
-                    bpy.ops.render.unity_6way_flipbook_export()
-                    return {'RUNNING_MODAL'}
-
-            context.window_manager.event_timer_remove(self._timer)
-
-            return {'FINISHED'}
-
-        def modal(self, context, event):
-            if context.scene.unity6way.is_locked:
-                return {'RUNNING_MODAL'}
-
-            if context.scene.unity6way.is_cancelled:
-                return {'CANCELLED'}
-
-            self._stage_index += 1
-            return self._run_next_stage(context)
+        bl_options = {'REGISTER'}
 
         def execute(self, context):
             unity6way = context.scene.unity6way
+            unity6way.is_cancelled = False
 
-            self._stages = []
+            stages = []
             if unity6way.lightmaps.enabled:
-                self._stages.append('LIGHTMAPS')
+                stages.append('LIGHTMAPS')
 
-            if unity6way.emissive.enabled:
-                self._stages.append('EMISSIVE')
+            if unity6way.emissive.enabled and not _use_lightmaps_emissive(context.scene):
+                stages.append('EMISSIVE')
 
             if unity6way.compositing.enabled:
-                self._stages.append('COMPOSITING')
+                stages.append('COMPOSITING')
 
             if unity6way.flipbook.enabled:
-                self._stages.append('FLIPBOOK')
-
-            self._timer = context.window_manager.event_timer_add(0.1, window=context.window)
+                stages.append('FLIPBOOK')
+
+            #compositing a lightmap frame as soon as it renders needs the emissive frames first
+            if 'EMISSIVE' in stages and 'COMPOSITING' in stages and _use_overlap(context.scene):
+                stages.remove('EMISSIVE')
+                stages.insert(0, 'EMISSIVE')
+
+            #lightmaps and emissive frames are independent, workers render both stages in parallel
+            worker_stages = [stage for stage in stages if stage in ('LIGHTMAPS', 'EMISSIVE')]
+            if unity6way.workers > 1 and not _is_worker and worker_stages:
+                stages = ['WORKERS'] + [stage for stage in stages if stage not in worker_stages]
+
+            #explicit frame lists are rendered as given
+            if unity6way.trim_empty_frames and _frames_override == None and stages:
+                stages = ['TRIM'] + stages
+
+            pipeline = _RenderPipeline(stages, worker_stages)
+            if bpy.app.background:
+                result = pipeline.run_blocking(context)
+                if pipeline.error != None:
+                    self.report({'ERROR'}, pipeline.error)
+                return result
+
+            pipeline.run(context)
+            return {'FINISHED'}
 
-            context.window_manager.modal_handler_add(self)
+    class CancelOperator(bpy.types.Operator):
+        """Stop rendering the remaining stages"""    #tooltip
+        bl_idname = "render.unity_6way_cancel"
+        bl_label = "Cancel"
 
-            self._stage_index = 0
-            return self._run_next_stage(context)
+        def execute(self, context):
+            if _active_pipeline != None:
+                _active_pipeline.cancel(context.scene)
+            return {'FINISHED'}
 
 class Unity6WayProperties(bpy.types.PropertyGroup):
     temp_path : bpy.props.StringProperty(
@@ -1295,6 +3882,87 @@ class Unity6WayProperties(bpy.types.PropertyGroup):
         default = 250,
         min = 1,
     )
+    trim_empty_frames: bpy.props.BoolProperty(
+        name = "Trim empty frames",
+        description = "Find the first and last frames with visible content in a low resolution pre-pass and only process the frames between them",
+        default = False,
+    )
+    trim_flipbook: bpy.props.BoolProperty(
+        name = "Fit flipbook",
+        description = "Spread the flipbook tiles over the visible frames instead of using the flipbook frame step",
+        default = False,
+    )
+    trimmed_range: bpy.props.IntVectorProperty(
+        size = 4,
+        default = (0, 0, 0, 0),
+    )
+    flipbook_frames_only: bpy.props.BoolProperty(
+        name = "Flipbook frames only",
+        description = "Only render and composite the frames used by the flipbook",
+        default = True,
+    )
+    workers: bpy.props.IntProperty(
+        name = "Workers",
+        description = "Background Blender processes rendering lightmap and emissive frames in parallel, 1 renders in this session",
+        default = 1,
+        min = 1,
+        max = 64,
+    )
+    worker_threads: bpy.props.IntProperty(
+        name = "Threads per worker",
+        description = "Render threads of each worker, 0 shares the available cores between workers",
+        default = 0,
+        min = 0,
+    )
+    worker_retries: bpy.props.IntProperty(
+        name = "Retries",
+        description = "Number of times a failed worker chunk is rendered again",
+        default = 2,
+        min = 0,
+    )
+    auto_resolution: bpy.props.BoolProperty(
+        name = "Match flipbook tiles",
+        description = "Render lightmaps, emission and node compositing at the flipbook tile size times the supersampling instead of the scene resolution, never above it",
+        default = True,
+    )
+    supersampling: bpy.props.IntProperty(
+        name = "Supersampling",
+        description = "Render resolution as a multiple of the flipbook tile size",
+        default = 2,
+        min = 1,
+        max = 8,
+    )
+    overlap_stages: bpy.props.BoolProperty(
+        name = "Composite while rendering",
+        description = "Composite each lightmap frame and place its flipbook tiles in the background while the next frame renders, with direct compositing and a single worker",
+        default = False,
+    )
+    memory_handoff: bpy.props.BoolProperty(
+        name = "Keep frames in memory",
+        description = "Hand the composited frames to the flipbook export in memory during Render all, files are only written for the cache or past the memory limit",
+        default = False,
+    )
+    memory_limit: bpy.props.IntProperty(
+        name = "Memory limit (MB)",
+        description = "Memory for frames kept between stages, the oldest frames are written to files beyond it",
+        default = 4096,
+        min = 64,
+    )
+    reuse_duplicate_frames: bpy.props.BoolProperty(
+        name = "Reuse duplicate frames",
+        description = "Render and composite frames identical to an earlier frame only once and copy its files",
+        default = False,
+    )
+    write_report: bpy.props.BoolProperty(
+        name = "Write report",
+        description = "Write the stage and frame timings of each run to unity6way_report.json in the temp path",
+        default = True,
+    )
+    use_cache: bpy.props.BoolProperty(
+        name = "Reuse unchanged frames",
+        description = "Skip frames whose scene content and settings did not change since they were written to the temp path",
+        default = False,
+    )
     lightmaps : bpy.props.PointerProperty(type=Unity6Way.Lightmaps.Properties)
     emissive : bpy.props.PointerProperty(type=Unity6Way.Emissive.Properties)
     compositing : bpy.props.PointerProperty(type=Unity6Way.Compositing.Properties)
@@ -1319,14 +3987,17 @@ classes = (
     Unity6Way.Emissive.ViewResultOperator,
 
     Unity6Way.Compositing.PrepareOperator,
+    Unity6Way.Compositing.DirectOperator,
     Unity6Way.Compositing.RestoreOperator,
     Unity6Way.Compositing.ViewResultOperator,
 
     Unity6Way.Flipbook.ExportOperator,
     Unity6Way.Flipbook.ViewResultOperator,
 
+    Unity6Way.TrimOperator,
     Unity6Way.RenderUndoOperator,
     Unity6Way.RenderAllOperator,
+    Unity6Way.CancelOperator,
 
     Unity6Way.Lightmaps.Properties,
     Unity6Way.Emissive.Properties,
@@ -1339,9 +4010,99 @@ def register():
     for cls in classes:
         bpy.utils.register_class(cls)
     bpy.types.Scene.unity6way = bpy.props.PointerProperty(type=Unity6WayProperties)
-    
+    bpy.app.handlers.load_pre.append(_on_load_pre)
+    if not bpy.app.background:
+        bpy.app.timers.register(_on_output_states_timer, first_interval=_output_rescan_interval, persistent=True)
+
 
 def unregister():
+    global _output_scanner
+    if bpy.app.timers.is_registered(_on_output_states_timer):
+        bpy.app.timers.unregister(_on_output_states_timer)
+    if _output_scanner != None:
+        _output_scanner.shutdown(wait=False)
+        _output_scanner = None
+    _output_scans.clear()
+    bpy.app.handlers.load_pre.remove(_on_load_pre)
     del bpy.types.Scene.unity6way
     for cls in classes:
         bpy.utils.unregister_class(cls)
+
+def _parse_frames(text):
+    # "1-100" or "1,5,9-12"
+    frames = set()
+    for part in text.split(","):
+        if "-" in part:
+            frame_start, frame_end = part.split("-")
+            frames.update(range(int(frame_start), int(frame_end) + 1))
+        else:
+            frames.add(int(part))
+    return sorted(frames)
+
+def main(argv):
+    # blender -b scene.blend -P unity_6way.py -- --stages lightmaps compositing flipbook --frames 1-100
+    import argparse
+    import traceback
+    global _frames_override, _is_worker
+
+    parser = argparse.ArgumentParser(prog="blender -b scene.blend -P unity_6way.py --",
+        description="Run the Unity 6-way lighting pipeline without user interface.")
+    parser.add_argument("--scene", help="scene to process, the active scene by default")
+    parser.add_argument("--stages", nargs="+", choices=("lightmaps", "emissive", "compositing", "flipbook"),
+        help="stages to run, the stages enabled in the scene by default")
+    parser.add_argument("--frames", help="frames to process, e.g. 1-100 or 1,5,9-12, the scene settings by default")
+    parser.add_argument("--temp-path", help="folder for intermediate files")
+    parser.add_argument("--workers", type=int, help="background Blender processes rendering frames in parallel")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    register()
+
+    scene = bpy.data.scenes.get(args.scene) if args.scene else bpy.context.scene
+    if scene == None:
+        print("Scene {0} not found".format(args.scene))
+        return 1
+    unity6way = scene.unity6way
+
+    if args.temp_path:
+        unity6way.temp_path = args.temp_path if args.temp_path[-1] in "/\\" else args.temp_path + os.sep
+
+    if args.workers:
+        unity6way.workers = args.workers
+
+    if args.worker:
+        #the scheduler owns the cache manifest and decides which frames to render
+        _is_worker = True
+        unity6way.use_cache = False
+
+    if args.stages:
+        unity6way.lightmaps.enabled = "lightmaps" in args.stages
+        unity6way.emissive.enabled = "emissive" in args.stages
+        unity6way.compositing.enabled = "compositing" in args.stages
+        unity6way.flipbook.enabled = "flipbook" in args.stages
+
+    if args.frames:
+        try:
+            frames = _parse_frames(args.frames)
+        except ValueError:
+            parser.error("invalid frames {0}".format(args.frames))
+        unity6way.frames = 'RANGE'
+        unity6way.frame_start = frames[0]
+        unity6way.frame_end = frames[-1]
+        if args.worker or len(frames) != frames[-1] - frames[0] + 1:
+            _frames_override = frames
+
+    #blender exits with 0 on errors in the script unless asked otherwise, failures are returned instead
+    try:
+        with bpy.context.temp_override(scene=scene):
+            result = bpy.ops.render.unity_6way_render_all()
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0 if result == {'FINISHED'} else 1
+
+if __name__ == "__main__":
+    if bpy.app.background:
+        sys.exit(main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []))
+    else:
+        register()
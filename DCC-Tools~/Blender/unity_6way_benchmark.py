@@ -0,0 +1,260 @@
+import bpy
+import os
+import sys
+import math
+import time
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+# blender -b --factory-startup -P unity_6way_benchmark.py -- --output results.json
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import unity_6way
+
+_flipbook_cases = (
+    # (atlas size, tiling)
+    (512, (4, 4)),
+    (2048, (8, 8)),
+    (4096, (8, 8)),
+    (4096, (16, 16)),
+)
+_quick_flipbook_cases = (
+    (512, (4, 4)),
+    (1024, (8, 8)),
+)
+
+def measure(results, name, params, function, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    result = {
+        "name": name,
+        "params": params,
+        "seconds": [round(timing, 4) for timing in timings],
+        "min": round(min(timings), 4),
+        "median": round(statistics.median(timings), 4),
+    }
+    results.append(result)
+    print("{0} {1}: min {2:.4f}s median {3:.4f}s".format(name, params, result["min"], result["median"]))
+
+def clear_scene(scene):
+    for object in list(bpy.data.objects):
+        bpy.data.objects.remove(object)
+    for material in list(bpy.data.materials):
+        bpy.data.materials.remove(material)
+    for image in list(bpy.data.images):
+        bpy.data.images.remove(image)
+    # the data of removed objects would stay behind as orphans and grow bpy.data from case to case
+    for collection in (bpy.data.meshes, bpy.data.lights, bpy.data.cameras):
+        for data in list(collection):
+            collection.remove(data)
+
+def create_cube(name, size):
+    vertices = [(x * size, y * size, z * size) for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(vertices, [], faces)
+    return bpy.data.objects.new(name, mesh)
+
+def create_smoke_material():
+    # procedural density instead of a simulation cache, so the scene needs no bake
+    material = bpy.data.materials.new("Smoke")
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    links = material.node_tree.links
+    nodes.remove(nodes["Principled BSDF"])
+    volume = nodes.new(type='ShaderNodeVolumePrincipled')
+    noise = nodes.new(type='ShaderNodeTexNoise')
+    noise.inputs["Scale"].default_value = 3
+    ramp = nodes.new(type='ShaderNodeValToRGB')
+    ramp.color_ramp.elements[0].position = 0.45
+    links.new(noise.outputs["Fac"], ramp.inputs["Fac"])
+    links.new(ramp.outputs["Color"], volume.inputs["Density"])
+    links.new(volume.outputs["Volume"], nodes["Material Output"].inputs["Volume"])
+    return material
+
+def create_emissive_material(index):
+    material = bpy.data.materials.new("Emissive{0:04d}".format(index))
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    emission = nodes.new(type='ShaderNodeEmission')
+    emission.inputs["Strength"].default_value = 1 + index % 5
+    if index % 2:
+        # half of the materials drive the strength from another node
+        value = nodes.new(type='ShaderNodeValue')
+        value.outputs[0].default_value = 2
+        material.node_tree.links.new(value.outputs[0], emission.inputs["Strength"])
+    material.node_tree.links.new(emission.outputs[0], nodes["Material Output"].inputs["Surface"])
+    return material
+
+def create_scene(scene, material_count, light_count, resolution, samples):
+    clear_scene(scene)
+
+    scene.render.engine = 'CYCLES'
+    scene.cycles.device = 'CPU'
+    scene.cycles.samples = samples
+    scene.cycles.use_denoising = False
+    scene.render.resolution_x = resolution
+    scene.render.resolution_y = resolution
+    scene.render.resolution_percentage = 100
+    scene.frame_start = 1
+    scene.frame_end = 1
+    if scene.world == None:
+        scene.world = bpy.data.worlds.new("World")
+
+    camera = bpy.data.objects.new("Camera", bpy.data.cameras.new("Camera"))
+    camera.location = (0, -6, 0)
+    camera.rotation_euler = (math.pi / 2, 0, 0)
+    scene.collection.objects.link(camera)
+    scene.camera = camera
+
+    smoke = create_cube("Smoke", 1)
+    smoke.data.materials.append(create_smoke_material())
+    scene.collection.objects.link(smoke)
+
+    # one small render-visible object uses every emissive material
+    emitter = create_cube("Emitter", 0.1)
+    emitter.location = (0, 0, -1.5)
+    for i in range(material_count):
+        emitter.data.materials.append(create_emissive_material(i))
+    scene.collection.objects.link(emitter)
+
+    for i in range(light_count):
+        light = bpy.data.objects.new("Light{0}".format(i), bpy.data.lights.new("Light{0}".format(i), 'POINT'))
+        angle = 2 * math.pi * i / max(1, light_count)
+        light.location = (4 * math.cos(angle), 4 * math.sin(angle), 2)
+        scene.collection.objects.link(light)
+
+def write_frames(unity6way, frames, size):
+    rng = np.random.default_rng(0)
+    pixels = rng.random((size, size, 4), dtype=np.float32)
+    for frame in frames:
+        for path in unity_6way._get_compositing_paths(unity6way, frame):
+            unity_6way._write_exr_rgba(path, pixels)
+
+def write_input_headers(unity6way, frames):
+    # tiny but valid files, so the checks parse headers and layers instead of rejecting empty files
+    pixels = np.zeros((4, 4), dtype=np.float32)
+    lightmap_channels = {"{0}.{1}".format(layer, channel): pixels
+        for layer in unity_6way._light_direction_names for channel in "RGB"}
+    lightmap_channels["Alpha.V"] = pixels
+    rgba = np.zeros((4, 4, 4), dtype=np.float32)
+    for frame in frames:
+        unity_6way._write_exr(unity_6way._get_lightmaps_path(unity6way, frame), lightmap_channels)
+        for path in unity_6way._get_compositing_paths(unity6way, frame):
+            unity_6way._write_exr_rgba(path, rgba)
+
+def benchmark_flipbook(results, scene, cases, repeat):
+    unity6way = scene.unity6way
+    for atlas_size, tiling in cases:
+        frame_count = tiling[0] * tiling[1]
+        tile_size = atlas_size // tiling[0]
+        frames = range(1, frame_count + 1)
+        # composited frames twice the tile size, as the flipbook downscales them
+        write_frames(unity6way, frames, tile_size * 2)
+
+        scene.frame_start = 1
+        scene.frame_end = frame_count
+        unity6way.frames = 'CURRENT'
+        unity6way.flipbook.image_size = (atlas_size, atlas_size)
+        unity6way.flipbook.tiling = tiling
+        unity6way.flipbook.frame_step = 1
+        unity6way.flipbook.dest_format = 'PNG'
+        for streaming in (False, True):
+            unity6way.flipbook.streaming = streaming
+            params = {"atlas_size": atlas_size, "tiling": list(tiling), "streaming": streaming}
+            measure(results, "flipbook_export", params, bpy.ops.render.unity_6way_flipbook_export, repeat)
+
+        for frame in frames:
+            for path in unity_6way._get_compositing_paths(unity6way, frame):
+                os.remove(path)
+
+def benchmark_check_input_paths(results, scene, frame_count, repeat):
+    unity6way = scene.unity6way
+    frames = list(range(1, frame_count + 1))
+    write_input_headers(unity6way, frames)
+
+    params = {"frames": frame_count}
+    measure(results, "compositing_check_input_paths", params,
+        lambda: unity_6way._check_compositing_input_paths(scene, frames), repeat)
+    measure(results, "flipbook_check_input_paths", params,
+        lambda: unity_6way._check_flipbook_input_paths(unity6way, frames), repeat)
+
+    for frame in frames:
+        for path in (unity_6way._get_lightmaps_path(unity6way, frame),) + unity_6way._get_compositing_paths(unity6way, frame):
+            os.remove(path)
+
+def benchmark_emissive_materials(results, scene, material_count, repeat):
+    create_scene(scene, material_count, 0, 64, 1)
+
+    def disable_and_restore():
+        unity_6way._restore_emissive_materials(unity_6way._disable_emissive_materials(scene))
+
+    measure(results, "disable_emissive_materials", {"materials": material_count}, disable_and_restore, repeat)
+
+def benchmark_lightmap_render(results, scene, light_count, resolution, samples, repeat):
+    create_scene(scene, 4, light_count, resolution, samples)
+    unity6way = scene.unity6way
+    unity6way.frames = 'FRAME'
+    unity6way.frame_start = 1
+    unity6way.use_cache = False
+    unity6way.auto_resolution = False
+    for use_lightgroups in (False, True):
+        unity6way.lightmaps.use_lightgroups = use_lightgroups
+        params = {"lights": light_count, "resolution": resolution, "samples": samples, "lightgroups": use_lightgroups}
+        measure(results, "lightmap_render", params, lambda: bpy.ops.render.unity_6way_render(
+            prepare_operator = "unity_6way_lightmap_prepare", restore_operator = "unity_6way_lightmap_restore", stage = 'LIGHTMAPS'), repeat)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="blender -b --factory-startup -P unity_6way_benchmark.py --",
+        description="Time the hot paths of the Unity 6-way lighting pipeline.")
+    parser.add_argument("--output", required=True, help="JSON file receiving the results")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the minimum and median are reported")
+    parser.add_argument("--quick", action="store_true", help="smaller cases for a fast smoke run")
+    parser.add_argument("--skip-render", action="store_true", help="skip the lightmap render cases")
+    args = parser.parse_args(argv)
+
+    unity_6way.register()
+    scene = bpy.context.scene
+    unity6way = scene.unity6way
+    unity6way.write_report = False
+
+    temp_path = tempfile.mkdtemp(prefix="unity6way_benchmark_")
+    unity6way.temp_path = os.path.join(temp_path, "")
+
+    results = []
+    try:
+        create_scene(scene, 0, 0, 64, 1)
+        benchmark_flipbook(results, scene, _quick_flipbook_cases if args.quick else _flipbook_cases, args.repeat)
+        for frame_count in ((1000,) if args.quick else (1000, 5000)):
+            benchmark_check_input_paths(results, scene, frame_count, args.repeat)
+        for material_count in ((500,) if args.quick else (500, 5000)):
+            benchmark_emissive_materials(results, scene, material_count, args.repeat)
+        if not args.skip_render:
+            benchmark_lightmap_render(results, scene, 4, 64 if args.quick else 128, 4, args.repeat)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+    report = {
+        "blender": bpy.app.version_string,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "quick": args.quick,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []))